@@ -0,0 +1,316 @@
+""" Benchmarks of optimised code paths against the code they replace. """
+
+import sys
+import timeit
+
+import numpy
+from scipy.signal import decimate
+
+import datapoint
+import plant
+
+
+def _best_time(f, repeat=3):
+    """ Returns: The fastest time in seconds of several calls to f. """
+    return min(timeit.repeat(f, number=1, repeat=repeat))
+
+
+def _report(name, old, new):
+    print "%s: old %.3fs, new %.3fs, speed-up %.1fx" % (name, old, new, old / new)
+
+
+def load_block(path):
+    """
+    Compare bulk parsing of a block data file against the csv row parser.
+
+    Args:
+        path: Path to a data.txt or data2.txt file.
+    """
+    old = _best_time(lambda: plant._load_block_rows(path))
+    new = _best_time(lambda: plant.load_block(path))
+
+    # the readings must be identical to the last bit
+    same = plant._load_block_rows(path).tostring() == plant.load_block(path).tostring()
+    print "Identical readings:", same
+    _report("load_block", old, new)
+
+
+def decimate_stream(num_samples=10000000, factor=10):
+    """
+    Compare streaming, chunked decimation against scipy's decimate on
+    random-walk readings of two electrodes.
+    """
+    num_samples = int(num_samples)
+    factor = int(factor)
+    readings = numpy.random.randn(num_samples, 2).cumsum(axis=0)
+
+    old = _best_time(lambda: decimate(readings, factor, ftype='fir', axis=0))
+    new = _best_time(lambda: plant.decimate_stream(readings, factor))
+
+    expected = decimate(readings, factor, ftype='fir', axis=0)
+    error = abs(plant.decimate_stream(readings, factor) - expected).max()
+    print "Max relative error:", error / abs(readings).max()
+    _report("decimate_stream", old, new)
+
+
+def float32_scores(path=".", seed=0, tolerance=0.02, feature_tolerance=1e-4):
+    """
+    Compare classifier scores with readings stored as float64 and float32,
+    to check that single precision does not cost accuracy.
+
+    Args:
+        path: Path to the data directory, as for plant.load_store.
+        seed: Seed of the split into training and validation plants.
+        tolerance: Largest difference in validation score allowed.
+        feature_tolerance:
+            Largest difference in any feature allowed, relative to the
+            largest float64 feature.
+    Raises:
+        AssertionError: If float32 differs from float64 by more than allowed.
+    """
+    # imported here, as learn needs sklearn and matplotlib
+    import learn
+    import transform
+    from sklearn import pipeline, preprocessing
+
+    seed = int(seed)
+    tolerance = float(tolerance)
+    feature_tolerance = float(feature_tolerance)
+
+    plants = plant.load_store(path)
+    preproc = [('avg', transform.ElectrodeAvg()),
+               ('detrend', transform.Detrend()),
+               ('poststim', transform.PostStimulus()),
+               ('dec', transform.Decimate(16))]
+    extract = [('feature', transform.FeatureEnsemble())]
+    postproc = [('scaler', preprocessing.StandardScaler())]
+
+    scores = {}
+    features = {}
+    try:
+        for dtype in [numpy.float64, numpy.float32]:
+            plant.dtype = dtype
+            classifier = learn.Classifier(preproc, extract, postproc)
+
+            # same windows and split for both types, with readings cast as
+            # a store of this type would hold them
+            X, y, sources = classifier.get_windows(plants)
+            X = numpy.array(X, dtype=dtype)
+            folds = datapoint.plant_folds(sources, 4, sorted(set(sources)))
+            train, valid = folds[seed % len(folds)]
+
+            X, y, sources = classifier.preprocess(X, y, sources)
+            pipe = classifier._pipeline()
+            pipe.fit(X[train], y[train])
+            scores[dtype] = pipe.score(X[valid], y[valid])
+            features[dtype] = pipeline.Pipeline(extract).transform(X)
+
+            print "%s: validation score %.4f, %d bytes of windows" % (
+                numpy.dtype(dtype).name, scores[dtype], X.nbytes)
+    finally:
+        plant.dtype = numpy.float64
+
+    error = abs(features[numpy.float32] - features[numpy.float64]).max()
+    error /= abs(features[numpy.float64]).max()
+    difference = scores[numpy.float32] - scores[numpy.float64]
+    print "Max feature error:", error
+    print "Score difference:", difference
+
+    assert features[numpy.float32].dtype == numpy.float32, \
+        "float32 features are %s" % features[numpy.float32].dtype
+    assert error <= feature_tolerance, "float32 features differ by %g, " \
+        "more than %g" % (error, feature_tolerance)
+    assert abs(difference) <= tolerance, "float32 score differs by %.4f, " \
+        "more than %.4f" % (difference, tolerance)
+
+
+def parmap_pool(num_windows=256, nprocs=2):
+    """
+    Compare the throughput of parmap's persistent, shared memory pool against
+    forking processes and queueing items one at a time for every call, on a
+    chain of five extractors over windows of two electrodes.
+    """
+    import parmap
+    import transform
+
+    num_windows = int(num_windows)
+    nprocs = int(nprocs)
+    X = numpy.random.randn(num_windows, datapoint.window_size, 2).cumsum(axis=1)
+    steps = [transform.ElectrodeAvg(), transform.Detrend(),
+             transform.PostStimulus(), transform.Decimate(16),
+             transform.FeatureEnsemble()]
+
+    def run(map_func):
+        T = X
+        for step in steps:
+            T = numpy.array(map_func(step.extractor, T, nprocs), ndmin=2)
+        return T
+
+    # start the pool first, as it lasts for the whole session
+    parmap.parmap(steps[0].extractor, X[:1], nprocs)
+
+    old = _best_time(lambda: run(parmap.queue_map))
+    new = _best_time(lambda: run(parmap.parmap))
+
+    print "Identical features:", numpy.array_equal(run(parmap.queue_map),
+                                                   run(parmap.parmap))
+    print "Windows per second: old %.1f, new %.1f" % (num_windows / old,
+                                                      num_windows / new)
+    _report("parmap", old, new)
+
+
+def transform_batch(num_windows=256):
+    """
+    Compare extractors run on whole arrays with transform_batch against
+    mapping them over every window with parmap.
+    """
+    import parmap
+    import transform
+
+    num_windows = int(num_windows)
+    X = numpy.random.randn(num_windows, datapoint.window_size, 2).cumsum(axis=1)
+    X1 = transform.ElectrodeAvg().transform(X)
+
+    for step, T in [(transform.ElectrodeAvg(), X),
+                    (transform.ElectrodeDiff(), X),
+                    (transform.Concat(), X),
+                    (transform.Transpose(), X),
+                    (transform.PostStimulus(), X),
+                    (transform.PreStimulus(), X),
+                    (transform.Abs(), X1),
+                    (transform.Differential(), X1),
+                    (transform.Mean(), X1),
+                    (transform.Var(), X1)]:
+        old = _best_time(lambda: numpy.array(parmap.parmap(step.extractor, T),
+                                             ndmin=2))
+        new = _best_time(lambda: step.transform(T))
+
+        same = numpy.array_equal(
+            numpy.array(parmap.parmap(step.extractor, T), ndmin=2),
+            step.transform(T))
+        _report("%s (identical: %s)" % (type(step).__name__, same), old, new)
+
+
+def fused_pipeline(num_windows=128, nprocs=2):
+    """
+    Compare a chain of extractors run as separate pipeline steps against the
+    same chain fused into a single pass over the windows.
+    """
+    import parmap
+    import transform
+    from sklearn import pipeline
+
+    num_windows = int(num_windows)
+    parmap.default_nprocs = int(nprocs)
+    X = numpy.random.randn(num_windows, datapoint.window_size, 2).cumsum(axis=1)
+    averaged = [('avg', transform.ElectrodeAvg()),
+                ('detrend', transform.Detrend()),
+                ('poststim', transform.PostStimulus()),
+                ('dec', transform.Decimate(16)),
+                ('diff', transform.Differential()),
+                ('abs', transform.Abs()),
+                ('feature', transform.FeatureEnsemble())]
+    # each electrode separately, through Map
+    separate = [('concat', transform.Concat()),
+                ('detrend', transform.Map(transform.Detrend(), divs=2)),
+                ('poststim', transform.Map(transform.PostStimulus(), divs=2)),
+                ('n', transform.Map(transform.Noise(1024), divs=2)),
+                ('m', transform.Map(transform.MovingAvg(256), divs=2)),
+                ('d', transform.Map(transform.Differential(), divs=2)),
+                ('me', transform.Map(transform.MeanSubtract(), divs=2)),
+                ('a', transform.Abs()),
+                ('c', transform.CrossCorrelation()),
+                ('f', transform.FeatureEnsemble())]
+
+    for name, steps in [("averaged", averaged), ("map", separate)]:
+        unfused = pipeline.Pipeline(steps)
+        fused = pipeline.Pipeline(transform.fuse(steps))
+
+        # start the pool first, as it lasts for the whole session
+        fused.transform(X[:1])
+
+        old = _best_time(lambda: unfused.transform(X))
+        new = _best_time(lambda: fused.transform(X))
+
+        print "Identical features:", numpy.array_equal(unfused.transform(X),
+                                                       fused.transform(X))
+        _report("fused_pipeline " + name, old, new)
+    parmap.default_nprocs = None
+
+
+def feature_ensemble(num_windows=256, size=1024):
+    """
+    Compare the single pass statistics kernel behind FeatureEnsemble against
+    combining the Mean, Var, Abs, Differential, Skewness and Kurtosis
+    extractors on each window, as FeatureEnsemble used to.
+    """
+    import transform
+
+    num_windows = int(num_windows)
+    size = int(size)
+    X = numpy.random.randn(num_windows, size).cumsum(axis=1)
+
+    def ensemble(x):
+        m = transform.Mean()
+        v = transform.Var()
+        a = transform.Abs()
+        d = transform.Differential()
+        hjorth_mob = v(d(x))**0.5 / v(x)**0.5
+        hjorth_com = (v(d(d(x)))**0.5 / v(d(x))**0.5) / hjorth_mob
+        return [m(x), m(a(d(x))), m(a(d(d(x)))), v(x), v(d(x)), v(d(d(x))),
+                hjorth_mob, hjorth_com,
+                transform.Skewness()(x), transform.Kurtosis()(x)]
+
+    feature = transform.FeatureEnsemble()
+    old = _best_time(lambda: [ensemble(x) for x in X])
+    window = _best_time(lambda: [feature.extractor(x) for x in X])
+    batch = _best_time(lambda: feature.transform_batch(X))
+
+    print "Identical features:", numpy.array_equal(
+        numpy.array([ensemble(x) for x in X]), feature.transform_batch(X))
+    _report("feature_ensemble per window", old, window)
+    _report("feature_ensemble batch", old, batch)
+
+
+def moving_avg(num_windows=64, size=4096, n=64):
+    """
+    Compare the cumulative sum MovingAvg and Noise against the running sum
+    loop they used to take over each window.
+    """
+    import transform
+
+    num_windows = int(num_windows)
+    size = int(size)
+    n = int(n)
+    X = numpy.random.randn(num_windows, size).cumsum(axis=1)
+
+    def loop(x):
+        mov_avg = []
+        accum = sum(x[:n])
+        for i, xx in enumerate(x):
+            mov_avg.append(accum / n)
+            try:
+                accum += x[i+n]
+            except IndexError:
+                break
+            accum -= x[i]
+        return mov_avg
+
+    def noise(x):
+        return [xx - ss for xx, ss in zip(x[n/2:-n/2], loop(x))]
+
+    for name, old_f, extractor in [("moving_avg", loop, transform.MovingAvg(n)),
+                                   ("noise", noise, transform.Noise(n))]:
+        old = _best_time(lambda: [old_f(x) for x in X])
+        window = _best_time(lambda: [extractor.extractor(x) for x in X])
+        batch = _best_time(lambda: extractor.transform_batch(X))
+
+        print "Identical %s:" % name, numpy.array_equal(
+            numpy.array([old_f(x) for x in X]), extractor.transform_batch(X))
+        _report(name + " per window", old, window)
+        _report(name + " batch", old, batch)
+
+
+if __name__ == '__main__':
+    # run a benchmark by name, e.g. python benchmark.py load_block data.txt
+    globals()[sys.argv[1]](*sys.argv[2:])
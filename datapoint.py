@@ -1,9 +1,13 @@
+from collections import namedtuple
 import numpy
+from numpy.lib.format import open_memmap
 import csv
-from itertools import groupby, chain
-import random
+import hashlib
+import os
+import shutil
 
 import plant
+import store
 
 # number of data points after every stimulus to use
 window_size = 16384+4096
@@ -14,115 +18,626 @@ window_offset = -4096
 # min offset of null data from start of readings and first stimuli
 null_offset = 512
 
+# number of null windows that overlap each reading
+null_overlap = 2
 
-def generate(plant_data, split_initial=False):
+# name of the file the window schedule is saved to, inside a plant store
+schedule_name = "schedule.npz"
+
+# name of the directory generated windows are cached in, inside a plant store
+cache_name = "windows"
+
+# number of data points in each batch when streaming data points
+batch_size = 256
+
+
+class Windows:
+    """
+    Windows of equal size over the readings of plants, stored as start offsets.
+
+    Every window is a view of the plant readings, so overlapping windows cost
+    nothing. Windows are only copied when converted to an array, e.g. with
+    numpy.array(windows).
+    """
+
+    def __init__(self, readings, starts, size, plants=None):
+        """
+        Args:
+            readings: A list of 2D arrays of readings, one per plant.
+            starts: The offset of every window in its readings.
+            size: The number of readings in every window.
+            plants: The index in readings of every window, defaults to 0.
+        """
+        self.readings = list(readings)
+        self.starts = numpy.asarray(starts, dtype=int)
+        self.size = size
+        if plants is None:
+            plants = numpy.zeros(len(self.starts), dtype=int)
+        self.plants = numpy.asarray(plants, dtype=int)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, key):
+        """
+        Returns:
+            For an integer, a view of the readings in the window. For a slice,
+            index array or boolean mask, a Windows of the selected windows.
+        """
+        if isinstance(key, (int, long, numpy.integer)):
+            start = self.starts[key]
+            return self.readings[self.plants[key]][start:start+self.size]
+        return Windows(self.readings, self.starts[key], self.size,
+                       self.plants[key])
+
+    def __iter__(self):
+        return (self[i] for i in xrange(len(self)))
+
+    def __array__(self, dtype=None):
+        """
+        Returns:
+            A copy of all windows as one contiguous 3D array, of the type of
+            the readings unless given.
+        """
+        shape = self.readings[0].shape[1:] if self.readings else ()
+        if dtype is None:
+            dtype = self.readings[0].dtype if self.readings else plant.dtype
+        X = numpy.empty((len(self), self.size) + shape, dtype=dtype)
+        for i, window in enumerate(self):
+            X[i] = window
+        return X
+
+    @staticmethod
+    def concat(windows, size=None):
+        """
+        Join several Windows into one, without copying any readings.
+
+        Args:
+            windows: A list of Windows.
+            size: The window size, needed if the list is empty.
+        Returns: A Windows of every window, in order.
+        """
+        readings = []
+        plants = []
+        for w in windows:
+            plants.append(w.plants + len(readings))
+            readings += w.readings
+
+        size = windows[0].size if windows else size
+        starts = [w.starts for w in windows]
+        return Windows(readings, numpy.concatenate(starts or [[]]), size,
+                       numpy.concatenate(plants or [[]]))
+
+
+# the size and placement of windows:
+#   size: number of readings in every window
+#   offset: offset of window from start of stimulus (positive = after)
+#   null_offset: min offset of null data from start of readings and first stimuli
+#   overlap: number of null windows that overlap each reading
+WindowSpec = namedtuple('WindowSpec',
+                        ['size', 'offset', 'null_offset', 'overlap'])
+
+
+def default_spec():
+    """ Returns: The WindowSpec given by the module settings. """
+    return WindowSpec(window_size, window_offset, null_offset, null_overlap)
+
+
+class Schedule:
+    """
+    The stimuli of a set of plants, independent of any WindowSpec.
+
+    The windows for any WindowSpec are found from a schedule with index
+    arithmetic alone, so trying different window configurations does not
+    re-scan the stimuli or touch any readings.
+    """
+
+    def __init__(self, names, lengths, plants, times, labels, initial):
+        """
+        Args:
+            names: The name of every plant.
+            lengths: The number of readings of every plant.
+            plants: The index in names of the plant of every stimulus.
+            times: The time of every stimulus, in readings.
+            labels: The type of every stimulus.
+            initial:
+                True for every stimulus that is the first of its type on its
+                plant.
+        """
+        self.names = list(names)
+        self.lengths = numpy.asarray(lengths, dtype=int)
+        self.plants = numpy.asarray(plants, dtype=int)
+        self.times = numpy.asarray(times, dtype=float)
+        self.labels = numpy.asarray(labels, dtype=object)
+        self.initial = numpy.asarray(initial, dtype=bool)
+
+    @staticmethod
+    def build(plants):
+        """
+        Args:
+            plants:
+                A list of (name, number of readings, stimuli) for every plant,
+                at the ideal sample frequency.
+        Returns: The Schedule of the plants.
+        """
+        names = []
+        lengths = []
+        stim_plants = []
+        times = []
+        labels = []
+        initial = []
+
+        for i, (name, num_readings, stimuli) in enumerate(plants):
+            names.append(name)
+            lengths.append(num_readings)
+            seen = set()
+            for stim in stimuli:
+                stim_plants.append(i)
+                times.append(stim.time)
+                labels.append(stim.type)
+                initial.append(stim.type not in seen)
+                seen.add(stim.type)
+
+        return Schedule(names, lengths, stim_plants, times, labels, initial)
+
+    @staticmethod
+    def load(path):
+        """ Returns: The Schedule saved at the given path. """
+        f = numpy.load(path)
+        return Schedule(f['names'].tolist(), f['lengths'], f['plants'],
+                        f['times'], f['labels'].tolist(), f['initial'])
+
+    def save(self, path):
+        """ Save the schedule, so it can be loaded with Schedule.load. """
+        numpy.savez(path, names=numpy.array(self.names, dtype=str),
+                    lengths=self.lengths, plants=self.plants, times=self.times,
+                    labels=numpy.array(self.labels, dtype=str),
+                    initial=self.initial)
+
+    def select(self, names):
+        """ Returns: A Schedule of only the named plants, in the given order. """
+        index = dict((name, i) for i, name in enumerate(self.names))
+        old = numpy.array([index[name] for name in names], dtype=int)
+
+        # new index of every old plant, -1 if it is not selected
+        new = numpy.empty(len(self.names), dtype=int)
+        new.fill(-1)
+        new[old] = numpy.arange(len(old))
+
+        # order stimuli by their new plant, keeping their order on a plant
+        keep = numpy.flatnonzero(new[self.plants] >= 0)
+        keep = keep[numpy.argsort(new[self.plants[keep]], kind='mergesort')]
+
+        return Schedule(names, self.lengths[old], new[self.plants[keep]],
+                        self.times[keep], self.labels[keep], self.initial[keep])
+
+    def windows(self, spec=None, split_initial=False):
+        """
+        Place windows on every plant. Windows that don't fit in the readings
+        (e.g. stimulus near end of data) are dropped.
+
+        Args:
+            spec: The WindowSpec to place, defaults to the module settings.
+            split_initial:
+                If true, label the initial application of each stimulus as a
+                separate class.
+        Returns:
+            The plant index, start and label of every window, ordered by
+            plant with stimulus windows before null windows.
+        """
+        spec = spec or default_spec()
+
+        labels = self.labels
+        if split_initial:
+            labels = numpy.where(self.initial, labels + '_init', labels)
+
+        # a window on each stimulus
+        plants = [self.plants]
+        starts = [(self.times + spec.offset).astype(int)]
+        y = [labels]
+
+        # null windows before the first stimulus of each plant
+        first_stim = numpy.empty(len(self.names))
+        first_stim.fill(numpy.inf)
+        numpy.minimum.at(first_stim, self.plants, self.times)
+        step = spec.size / spec.overlap
+        for i, first in enumerate(first_stim):
+            if numpy.isinf(first):
+                # no stimuli, so nothing marks the end of the null data
+                continue
+            null_starts = numpy.arange(spec.null_offset,
+                                       first - spec.size - spec.null_offset,
+                                       step).astype(int)
+            null_y = numpy.repeat(numpy.array(['null'], dtype=object),
+                                  len(null_starts))
+            if split_initial and len(null_y):
+                null_y[0] = 'null_init'
+            plants.append(numpy.repeat(i, len(null_starts)))
+            starts.append(null_starts)
+            y.append(null_y)
+
+        plants = numpy.concatenate(plants)
+        starts = numpy.concatenate(starts)
+        y = numpy.concatenate(y)
+
+        # stable sort by plant, stimulus windows come first
+        order = numpy.argsort(plants, kind='mergesort')
+        plants, starts, y = plants[order], starts[order], y[order]
+
+        ends = numpy.minimum(self.lengths[plants], starts + spec.size)
+        fits = (starts >= 0) & (ends - starts == spec.size)
+        for i in numpy.flatnonzero(~fits):
+            print "Dropping stimulus %s, window too small" % self.names[plants[i]]
+            print "Size: %d, Required: %d" % (max(0, ends[i] - starts[i]),
+                                             spec.size)
+
+        return plants[fits], starts[fits], list(y[fits])
+
+
+def schedule(plants):
+    """
+    Find the schedule of a list of plants.
+
+    The schedule of a whole plant store is saved next to it and reused until
+    the store changes, so it is only found once.
+
+    Params:
+        plants:
+            A PlantStore, or a list of PlantData at the ideal sample frequency.
+    Returns: The Schedule of the plants, in the given order.
+    """
+    if not isinstance(plants, store.PlantStore):
+        return Schedule.build((p.name, len(p.readings), p.stimuli)
+                              for p in plants)
+
+    path = os.path.join(plants.path, schedule_name)
+    index_file = os.path.join(plants.path, store.index_name)
+    if not os.path.isfile(index_file):
+        # not a store yet, e.g. a data directory with no experiments
+        return Schedule.build((e.name, e.shape[0], e.stimuli)
+                              for e in plants.entries)
+    elif (os.path.isfile(path) and
+            os.path.getmtime(path) >= os.path.getmtime(index_file)):
+        full = Schedule.load(path)
+    else:
+        # the store index has every stimulus and shape, so no readings are read
+        entries = store.PlantStore(plants.path).entries
+        full = Schedule.build((e.name, e.shape[0], e.stimuli) for e in entries)
+        full.save(path)
+
+    return full.select(plants.names())
+
+
+def generate(plant_data, split_initial=False, spec=None):
     """
     Process plant data to produce a list of classified data points.
     If split_initial is true, treat initial application of each stimulus
     as a separate class.
+
+    Params:
+        spec: The WindowSpec of the data points, defaults to the module settings.
+    Returns:
+        Windows of the readings for every data point, their labels and
+        their sources.
     """
+    spec = spec or default_spec()
 
-    # if sample rate is not close to ideal sample rate, drop this data
-    if plant.ideal_freq / plant_data.sample_freq < 0.9:
-        print "Dropping data %s, bad sample rate" % plant_data.name
-        return None
+    # bring data at any other sample rate to the ideal sample rate
+    if plant_data.sample_freq != plant.ideal_freq:
+        try:
+            plant_data = plant.resample(plant_data, plant.ideal_freq)
+        except ValueError, e:
+            print "Skipping %s: %s" % (plant_data.name, e)
+            return Windows([plant_data.readings], [], spec.size), [], []
 
-    X = []
-    y = []
+    plants, starts, y = schedule([plant_data]).windows(spec, split_initial)
 
-    stim_types = set()
+    X = Windows([plant_data.readings], starts, spec.size)
+    return X, y, [plant_data.name] * len(X)
 
-    def add_window(start, stim_type):
-        if split_initial and stim_type not in stim_types:
-            # this is the first appearance of a stimulus
-            stim_types.add(stim_type)
-            stim_type += '_init'
 
-        window = plant_data.readings[start:start+window_size]
+def generate_all(plants, split_initial=False, spec=None):
+    """
+    Process a list of plant data.
 
-        # skip if window is not large enough (e.g. stimulus near end of data)
-        if len(window) == window_size:
-            X.append(window)
-            y.append(stim_type)
-        else:
-            print "Dropping stimulus %s, window too small" % plant_data.name
-            print "Size: %d, Required: %d" % (len(window), window_size)
+    Params:
+        plants: A PlantStore or a list of PlantData
+        spec: The WindowSpec of the data points, defaults to the module settings.
+    Returns:
+        Windows of the readings for every data point, their labels and
+        their sources.
+    """
+    spec = spec or default_spec()
 
-    for stim in plant_data.stimuli:
-        # create a window on each stimulus
-        add_window(stim.time + window_offset, stim.type)
+    if not isinstance(plants, store.PlantStore):
+        return _concat(generate_stream(plants, split_initial, spec), spec.size)
 
-    first_stim = min([s.time for s in plant_data.stimuli])
+    names = plants.names()
+    plant_index, starts, y = cached_windows(plants, split_initial, spec)
 
-    # get null stimulus from windows before the first stimulus
-    null_start = null_offset
-    overlap = 2
-    while null_start + window_size + null_offset < first_stim:
-        add_window(null_start, 'null')
-        null_start += window_size / overlap
+    # readings are only mapped here, windows are views over them
+    X = Windows([plants[name].readings for name in names], starts, spec.size,
+                plant_index)
+    return X, y, [names[i] for i in plant_index]
 
-    return X, y, [plant_data.name] * len(X)
 
+def generate_stream(plants, split_initial=False, spec=None):
+    """
+    Process a list of plant data one plant at a time.
 
-def generate_all(plants, *args, **kwargs):
+    Params:
+        plants: A PlantStore or a list of PlantData
+        spec: The WindowSpec of the data points, defaults to the module settings.
+    Yields:
+        Batches of at most batch_size data points, as Windows of the readings,
+        their labels and their sources. Only one plant is processed at a time.
     """
-    Process a list of plant data.
+    spec = spec or default_spec()
+
+    if not isinstance(plants, store.PlantStore):
+        for plant_data in plants:
+            X, y, sources = generate(plant_data, split_initial, spec)
+            for batch in batches(X, y, sources):
+                yield batch
+        return
+
+    plant_index, starts, y = cached_windows(plants, split_initial, spec)
+    bounds = numpy.searchsorted(plant_index, numpy.arange(len(plants) + 1))
+    for i, name in enumerate(plants.names()):
+        lo, hi = bounds[i], bounds[i+1]
+        X = Windows([plants[name].readings], starts[lo:hi], spec.size)
+        for batch in batches(X, y[lo:hi], [name] * (hi - lo)):
+            yield batch
+
+
+def cached_windows(plants, split_initial=False, spec=None):
+    """
+    Place windows on the plants of a store, caching them inside the store.
+
+    The cache is keyed by everything the windows depend on, so repeated runs
+    skip placing windows entirely and changed plants are never served stale
+    windows.
 
     Params:
-        plants: A list of PlantData
+        plants: A PlantStore.
+        spec: The WindowSpec of the data points, defaults to the module settings.
+    Returns:
+        The plant index, memory-mapped start and label of every window, as
+        from Schedule.windows.
     """
+    spec = spec or default_spec()
+    if not os.path.isfile(os.path.join(plants.path, store.index_name)):
+        # nowhere to keep the cache
+        return schedule(plants).windows(spec, split_initial)
+
+    path = os.path.join(plants.path, cache_name,
+                        cache_key(plants, split_initial, spec))
+
+    if os.path.isdir(path):
+        print "Loading windows from cache %s" % path
+    else:
+        plant_index, starts, y = schedule(plants).windows(spec, split_initial)
+
+        # write to a temporary directory first so readers never see a partial
+        # cache, e.g. from another process generating the same windows
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        os.makedirs(tmp_path)
+        numpy.save(os.path.join(tmp_path, "plants.npy"), plant_index)
+        numpy.save(os.path.join(tmp_path, "starts.npy"), starts)
+        numpy.save(os.path.join(tmp_path, "y.npy"), numpy.array(y, dtype=str))
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path)
+
+    plant_index = numpy.load(os.path.join(path, "plants.npy"), mmap_mode='r')
+    starts = numpy.load(os.path.join(path, "starts.npy"), mmap_mode='r')
+    y = numpy.load(os.path.join(path, "y.npy"), mmap_mode='r')
+    return plant_index, starts, y.tolist()
+
+
+def cache_key(plants, split_initial, spec):
+    """
+    Returns:
+        A hash of the plant names, lengths and stimuli of a PlantStore and the
+        window settings, the only things the placement of windows depends on.
+    """
+    key = hashlib.sha1()
+    key.update(repr((tuple(spec), bool(split_initial))))
+    for entry in plants.entries:
+        key.update(repr((entry.name, entry.shape[0], entry.stimuli)))
+    return key.hexdigest()
+
+
+def _concat(stream, size):
+    """ Returns: All batches of a stream of data points, joined together. """
     X = []
     y = []
     sources = []
 
-    for plant_data in plants:
-        result = generate(plant_data, *args, **kwargs)
-        if result is None:
-            continue
-        Xp, yp, sourcep = result
-        X += Xp
+    for Xp, yp, sourcep in stream:
+        X.append(Xp)
         y += yp
         sources += sourcep
 
-    return X, y, sources
+    return Windows.concat(X, size), y, sources
 
 
-def save(path, X, y, sources):
+def batches(X, y, sources, size=None):
     """
-    Save data points to a CSV file.
+    Split data points into batches.
 
     Params:
-        path: File to save data points to.
+        size: The maximum number of data points in a batch.
+    Yields: Batches of data points, their labels and their sources.
     """
+    size = size or batch_size
+    for i in range(0, len(X), size):
+        yield X[i:i+size], y[i:i+size], sources[i:i+size]
 
-    with file(path, 'w') as f:
-        writer = csv.writer(f)
-        for xx, yy, source in zip(X, y, sources):
-            # write a row for every data point
-            writer.writerow([yy, source] + xx.T.flatten().tolist())
 
+def sliding(readings, stride, size=None):
+    """
+    Take windows at regular intervals over readings, e.g. to classify a whole
+    recording. Windows are views, so the readings are never copied.
 
-def load(path):
+    Params:
+        readings: The readings of a plant, such as a memory-mapped array.
+        stride: The number of readings between the starts of windows.
+        size: The number of readings in every window.
+    Returns: Windows of every window that fits in the readings.
     """
-    Load data points from a csv file.
+    size = size or window_size
+    starts = numpy.arange(0, len(readings) - size + 1, stride)
+    return Windows([readings], starts, size)
+
+
+def sliding_stream(readings, stride, size=None, batch=None):
+    """
+    Take sliding windows over readings in batches.
 
     Params:
-        path: File to load data points from.
+        batch: The maximum number of windows in a batch.
+    Yields: Batches of Windows and the start of every window in the readings.
     """
+    X = sliding(readings, stride, size)
+    batch = batch or batch_size
+    for i in range(0, len(X), batch):
+        yield X[i:i+batch], X.starts[i:i+batch]
+
+
+class SlidingBuffer:
+    """
+    Sliding windows over readings that are still being recorded.
+
+    Readings are appended as they arrive, and every window that has been
+    completed is returned. Only the readings that later windows need are kept.
+    """
+
+    def __init__(self, stride, size=None):
+        """
+        Params:
+            stride: The number of readings between the starts of windows.
+            size: The number of readings in every window.
+        """
+        self.stride = stride
+        self.size = size or window_size
+        self.readings = None
+        # position of the first kept reading and of the next window
+        self.offset = 0
+        self.next_start = 0
+
+    def append(self, readings):
+        """
+        Params:
+            readings: New readings, following on from all previous readings.
+        Returns:
+            Windows of every window completed by the new readings, and the
+            start of every window since the first reading.
+        """
+        if self.readings is None:
+            self.readings = numpy.array(readings)
+        else:
+            self.readings = numpy.concatenate([self.readings, readings])
+
+        end = self.offset + len(self.readings)
+        starts = numpy.arange(self.next_start, end - self.size + 1, self.stride)
+        X = Windows([self.readings], starts - self.offset, self.size)
+
+        if len(starts):
+            self.next_start = starts[-1] + self.stride
+
+        # drop readings before the next window, returned windows keep theirs
+        drop = min(self.next_start - self.offset, len(self.readings))
+        self.readings = self.readings[drop:]
+        self.offset += drop
+
+        return X, starts
 
-    X = []
-    y = []
 
-    with file(path, 'r') as f:
-        reader = csv.reader(f)
-        for row in reader:
-            xx = map(float, row[1:])
-            xx = numpy.array(xx)
-            xx = numpy.reshape(xx, (2, -1)).T  # reshape into two columns
-            X.append(xx)
-            y.append(row[0])
+def save(path, X, y, sources, dtype=numpy.float64):
+    """
+    Save data points to a binary dataset.
+
+    A dataset is a directory with one .npy array each for the windows, labels
+    and sources, so any part of it can be memory-mapped when loading.
+
+    Params:
+        path: Directory to save data points to, created if it does not exist.
+        dtype: Type of the saved windows, float64 is lossless for readings.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    shape = (len(X),) + numpy.shape(X[0]) if len(X) else (0, window_size)
+
+    # copy one window at a time, so windows never need to all be in memory
+    X_file = open_memmap(os.path.join(path, "X.npy"), 'w+', dtype, shape)
+    for i, xx in enumerate(X):
+        X_file[i] = xx
+    X_file.flush()
+    del X_file
+
+    numpy.save(os.path.join(path, "y.npy"), numpy.array(y, dtype=str))
+    numpy.save(os.path.join(path, "sources.npy"), numpy.array(sources, dtype=str))
+
+
+def load(path, rows=None):
+    """
+    Load data points from a binary dataset.
+
+    Params:
+        path: Directory to load data points from.
+        rows:
+            Indices, slice or mask of the data points to load. Only these
+            data points are read, defaults to a memory-map of all of them.
+    Returns: The windows, labels and sources of the data points.
+    """
+    X = numpy.load(os.path.join(path, "X.npy"), mmap_mode='r')
+    y = numpy.load(os.path.join(path, "y.npy"), mmap_mode='r')
+    sources = numpy.load(os.path.join(path, "sources.npy"), mmap_mode='r')
+
+    if rows is not None:
+        return X[rows], y[rows], sources[rows]
+    return X, y, sources
+
 
-    return X, y
+def convert_csv(csv_path, path, dtype=numpy.float64):
+    """
+    Convert data points saved in the old CSV format to a binary dataset.
+
+    Params:
+        csv_path: CSV file with a data point on every row.
+        path: Directory to save the binary dataset to.
+    """
+    with file(csv_path, 'r') as f:
+        num_rows = sum(1 for line in f if line.strip())
+
+    def rows():
+        with file(csv_path, 'r') as f:
+            for row in csv.reader(f):
+                if row:
+                    yield row
+
+    # rows are the label, source and then each electrode's readings in turn
+    first = next(rows())
+    shape = (num_rows, (len(first) - 2) / 2, 2)
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    X = open_memmap(os.path.join(path, "X.npy"), 'w+', dtype, shape)
+    y = []
+    sources = []
+    for i, row in enumerate(rows()):
+        X[i] = numpy.array(row[2:], dtype=float).reshape((2, -1)).T
+        y.append(row[0])
+        sources.append(row[1])
+    X.flush()
+    del X
+
+    numpy.save(os.path.join(path, "y.npy"), numpy.array(y, dtype=str))
+    numpy.save(os.path.join(path, "sources.npy"), numpy.array(sources, dtype=str))
 
 
 def filter_types(X, y, types):
@@ -131,49 +646,164 @@ def filter_types(X, y, types):
         classes: The allowed stimulus types.
     Returns: All datapoints of the given types.
     """
-    return zip(*filter((lambda d: d[1] in types), zip(X, y)))
+    indices = numpy.flatnonzero(type_mask(y, types))
+    return take(X, indices), take(y, indices)
 
 
 def group_types(X, y):
     """ Returns: The datapoints grouped together by type. """
+    types, groups = group_indices(y)
+    return [(yy, (take(X, g), take(y, g))) for yy, g in zip(types, groups)]
+
+
+def label_codes(y):
+    """
+    Returns:
+        The sorted types in y, and the index of every datapoint's type in
+        that list as an integer array.
+    """
+    types, codes = numpy.unique(numpy.asarray(y), return_inverse=True)
+    return list(types), codes
+
+
+def type_mask(y, types):
+    """ Returns: A boolean mask of the datapoints of the given types. """
+    all_types, codes = label_codes(y)
+    allowed = numpy.array([t in types for t in all_types], dtype=bool)
+    return allowed[codes]
 
-    def by_type(d):
-        return d[1]
 
-    groups = groupby(sorted(zip(X, y), key=by_type), key=by_type)
-    return [(yy, zip(*g)) for yy, g in groups]
+def group_indices(y):
+    """ Returns: The sorted types in y and the indices of each type. """
+    types, codes = label_codes(y)
+    order = numpy.argsort(codes, kind='mergesort')
+    bounds = numpy.cumsum(numpy.bincount(codes, minlength=len(types)))[:-1]
+    return types, numpy.split(order, bounds)
 
 
-def sample(X, y, group_size):
+def plant_indices(sources, names):
+    """
+    Params:
+        sources: The source plant of every datapoint.
+        names: The plants to select.
+    Returns:
+        Indices of the datapoints of the named plants, grouped by plant in
+        the given order.
+    """
+    plants, groups = group_indices(sources)
+    by_name = dict(zip(plants, groups))
+    indices = [by_name.get(name, []) for name in names]
+    return numpy.concatenate(indices or [[]]).astype(int)
+
+
+def plant_folds(sources, k, names=None):
+    """
+    Split datapoints into folds of whole plants, so no plant is in both the
+    training and validation data of a fold.
+
+    Params:
+        sources: The source plant of every datapoint.
+        k: The number of folds, at most the number of plants.
+        names: The order plants are dealt into folds, defaults to sorted.
+    Returns: A list of training and validation indices for every fold.
+    """
+    if names is None:
+        names = group_indices(sources)[0]
+
+    folds = []
+    for valid in numpy.array_split(numpy.arange(len(names)), min(k, len(names))):
+        valid = set(valid)
+        train = [n for i, n in enumerate(names) if i not in valid]
+        valid = [n for i, n in enumerate(names) if i in valid]
+        folds.append((plant_indices(sources, train),
+                      plant_indices(sources, valid)))
+    return folds
+
+
+def sample(X, y, group_size, seed=None):
+    """
+    Returns: A random sample of group_size datapoints, see sample_indices.
+    """
+    indices = sample_indices(len(X), group_size, _rng(seed))
+    return take(X, indices), take(y, indices)
+
+
+def sample_indices(num, group_size, rng=None):
+    """
+    Params:
+        num: The number of datapoints to sample from.
+        group_size: The number of datapoints to sample.
+        rng: A numpy RandomState to sample with, defaults to numpy.random.
+    Returns: Indices of a random sample of datapoints.
+    """
+    rng = rng or numpy.random
     # if class is too small, duplicate data and sample remainder
     # if class is too big, duplicate will be empty, take random sample
-    duplicate = zip(X, y) * int(group_size / len(X))
-    sample = random.sample(zip(X, y), group_size % len(X))
-    return zip(*(duplicate + sample))
+    duplicate = numpy.tile(numpy.arange(num), group_size / num)
+    sample = rng.choice(num, group_size % num, replace=False)
+    return numpy.concatenate((duplicate, sample))
 
 
-def balance(X, y, undersample=True):
+def balance(X, y, undersample=True, seed=None):
     """
     Params:
         undersample:
             True to reduce the size of common classes, false to
             replicate datapoints in uncommon classes.
+        seed:
+            Seed of the random sampling, for reproducible results. Defaults
+            to the global state of numpy.random.
     Returns: A subset with the same number of every represented type.
     """
+    indices = balance_indices(y, undersample, seed)
+    return take(X, indices), take(y, indices)
+
+
+def balance_indices(y, undersample=True, seed=None):
+    """
+    Params:
+        y: The type of every datapoint.
+        undersample:
+            True to reduce the size of common classes, false to
+            replicate datapoints in uncommon classes.
+        seed:
+            Seed of the random sampling, for reproducible results. Defaults
+            to the global state of numpy.random.
+    Returns:
+        Indices of a subset with the same number of every represented type.
+        Replicated datapoints appear more than once.
+    """
     print "Balancing dataset"
 
+    types, groups = group_indices(y)
+
     # find smallest datapoint type to decide how to balance
-    all_sizes = [len(list(ys)) for yy, (Xs, ys) in group_types(X, y)]
+    all_sizes = [len(g) for g in groups]
     if undersample:
         group_size = min(all_sizes)
     else:
         group_size = max(all_sizes)
 
-    print [(yy, len(list(ys))) for yy, (Xs, ys) in group_types(X, y)]
+    print zip(types, all_sizes)
 
     # pick a random sample from each group
-    samples = [sample(Xs, ys, group_size) for yy, (Xs, ys) in group_types(X, y)]
-    X, y = zip(*samples)
+    rng = _rng(seed)
+    samples = [g[sample_indices(len(g), group_size, rng)] for g in groups]
+    return numpy.concatenate(samples or [[]]).astype(int)
+
 
-    # concatenate all samples and return
-    return (numpy.array(list(chain(*X))), numpy.array(list(chain(*y))))
+def _rng(seed):
+    """ Returns: A RandomState for a seed, or numpy.random if seed is None. """
+    # an unseeded RandomState would not follow numpy.random.seed
+    return numpy.random if seed is None else numpy.random.RandomState(seed)
+
+
+def take(X, indices):
+    """
+    Returns:
+        The datapoints at the given indices. Windows and arrays are indexed
+        directly, so windows are shared rather than copied.
+    """
+    if isinstance(X, (numpy.ndarray, Windows)):
+        return X[indices]
+    return [X[i] for i in indices]
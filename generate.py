@@ -12,15 +12,15 @@ import matplotlib.pyplot as plt
 
 # load all plant data in directory
 print "Loading data"
-plants = plant.load_all()
+plants = plant.load_store()
 
 # process all data
 print "Processing data"
 X, y, sources = datapoint.generate_all(plants)
 
 # write data to file
-print "Writing to data.csv"
-datapoint.save("data.csv", X, y, sources)
+print "Writing to dataset data"
+datapoint.save("data", X, y, sources)
 
 concat = transform.Concat()
 split = transform.Split(divs=2)
@@ -0,0 +1,176 @@
+""" Opt-in instrumentation of the time and memory spent in stages of a task. """
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import resource
+import time
+
+# whether stages are being recorded
+enabled = False
+
+# name of the experiment that stages are recorded for
+experiment = None
+
+# stages recorded in this process
+_records = []
+
+# peak memory so far of every stage being recorded, outermost first
+_open = []
+
+
+def enable():
+    """ Start recording stages, discarding any previous records. """
+    global enabled
+    enabled = True
+    del _records[:]
+
+
+def disable():
+    """ Stop recording stages. """
+    global enabled
+    enabled = False
+
+
+@contextmanager
+def stage(name):
+    """
+    Record the wall time and peak resident memory of a stage, if enabled.
+    The peak is the stage's own, including any stages inside it.
+    Yields a dictionary for counts, such as bytes read or rows parsed.
+
+    Args:
+        name: Name of the stage, such as 'parse'.
+    """
+    counts = {}
+    if not enabled:
+        yield counts
+        return
+
+    start = time.time()
+    if _open:
+        # keep the peak of the enclosing stage, before it is reset
+        _open[-1] = max(_open[-1], _memory()[0])
+    reset = _reset_peak()
+    entry_peak, entry_rss = _memory()
+    _open.append(0)
+    try:
+        yield counts
+    finally:
+        peak, rss = _memory()
+        if not reset and peak == entry_peak and rss is not None:
+            # the process peak was before this stage, so only the memory at
+            # either end of the stage is known
+            peak = max(entry_rss, rss)
+        peak = max(peak, _open.pop())
+        if _open:
+            _open[-1] = max(_open[-1], peak)
+
+        record = dict(counts)
+        record['stage'] = name
+        record['experiment'] = experiment
+        record['time'] = time.time() - start
+        record['peak_rss'] = peak
+        _records.append(record)
+
+
+def mark():
+    """ Returns: A mark to collect only the records made after it. """
+    return len(_records)
+
+
+def collect(since=0):
+    """
+    Remove and return records of this process, e.g. to send from a worker.
+
+    Args:
+        since: A mark, records made before it are kept.
+    Returns: A list of records.
+    """
+    records = _records[since:]
+    del _records[since:]
+    return records
+
+
+def add(records):
+    """ Add records collected in another process. """
+    _records.extend(records)
+
+
+def summarise(records):
+    """
+    Args:
+        records: A list of recorded stages.
+    Returns:
+        A dictionary of totals by stage: the number of calls, wall time, all
+        counts and the peak resident memory in bytes.
+    """
+    stages = OrderedDict()
+    for record in records:
+        total = stages.setdefault(record['stage'],
+                                  OrderedDict([('calls', 0), ('time', 0.0)]))
+        total['calls'] += 1
+        for key, value in record.iteritems():
+            if key in ('stage', 'experiment'):
+                continue
+            elif key == 'peak_rss':
+                total[key] = max(total.get(key, 0), value)
+            else:
+                total[key] = total.get(key, 0) + value
+    return stages
+
+
+def report(path=None):
+    """
+    Summarise all records by stage and by experiment.
+
+    Args:
+        path: File to write the report to as JSON, if given.
+    Returns: The report as a dictionary.
+    """
+    # stages outside of any experiment only appear in the totals
+    experiments = OrderedDict()
+    for name in sorted(set(r['experiment'] for r in _records) - set([None])):
+        experiments[name] = summarise(
+            [r for r in _records if r['experiment'] == name])
+
+    result = OrderedDict([('stages', summarise(_records)),
+                          ('experiments', experiments)])
+
+    if path is not None:
+        # sorted and indented, so reports from different runs can be diffed
+        with file(path, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+    return result
+
+
+def _reset_peak():
+    """
+    Reset the peak resident memory of this process to its current memory.
+    Returns: True if it was reset, which is only possible on Linux.
+    """
+    try:
+        with file('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except IOError:
+        return False
+
+
+def _memory():
+    """
+    Returns:
+        The peak resident memory of this process since it was last reset and
+        its current resident memory in bytes. The current memory is None
+        where /proc is not available.
+    """
+    try:
+        with file('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+        # values are in kilobytes
+        return (int(status['VmHWM'].split()[0]) * 1024,
+                int(status['VmRSS'].split()[0]) * 1024)
+    except (IOError, KeyError, ValueError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, None
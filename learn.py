@@ -11,6 +11,8 @@ import os
 import plant
 import datapoint
 import plot
+import store
+import transform
 
 
 def_labels = ['null', 'ozone', 'H2SO4']
@@ -51,46 +53,96 @@ class Classifier:
         self.labels = labels or def_labels
 
     def _gen_datapoints(self, plants):
-        return datapoint.generate_all(plants)
+        return datapoint.generate_stream(plants)
 
-    def get_data(self, plants=None):
+    def get_windows(self, plants=None):
+        """
+        Returns:
+            Windows of every data point of a relevant type, their labels and
+            their sources, before balancing or preprocessing.
+        """
         # load plants if parameter not provided
         if plants is None:
-            plants = plant.load_all()
-        # extract windows from plant data
-        X, y, sources = self._gen_datapoints(plants)
-        # filter to relevant datapoint types
-        X, y = datapoint.filter_types(zip(X, sources), y, self.labels)
-        # balance the dataset
-        X, y = datapoint.balance(X, y, False)
+            plants = plant.load_store()
+
+        # extract windows from plant data, one plant at a time
+        X = []
+        y = []
+        sources = []
+        for Xp, yp, sp in self._gen_datapoints(plants):
+            # filter to relevant datapoint types
+            keep = np.flatnonzero(datapoint.type_mask(yp, self.labels))
+            X.append(Xp[keep])
+            y += datapoint.take(yp, keep)
+            sources += datapoint.take(sp, keep)
+        X = datapoint.Windows.concat(X, datapoint.window_size)
+        return X, np.array(y), np.array(sources)
 
-        X, sources = zip(*X)
+    def get_data(self, plants=None):
+        X, y, sources = self.get_windows(plants)
 
-        return self.preprocess(np.array(X), np.array(y), np.array(sources))
+        # balance the dataset, sharing replicated windows
+        indices = datapoint.balance_indices(y, False)
+        return self._preprocess_all(X[indices], y[indices], sources[indices])
 
-    def preprocess(self, X, y=None, sources=None):
+    def _stateless_preprocessing(self):
+        """ Returns: True if no preprocessing step learns from the data. """
+        return all(transform._stateless(step)
+                   for name, step in self.preproc_pipe)
+
+    def _preprocess_all(self, X, y, sources):
+        # preprocess in batches, so windows are never all copied at once
+        # steps that learn from the data are fit once on every window
         print "Preprocessing data"
-        return pipeline.Pipeline(self.preproc_pipe).fit_transform(X), y, sources
+        size = None if self._stateless_preprocessing() else max(len(X), 1)
+        data = [self.preprocess(np.array(Xb), yb, sb) for Xb, yb, sb in
+                datapoint.batches(X, y, sources, size)]
+        X, y, sources = zip(*data)
+
+        return np.concatenate(X), np.concatenate(y), np.concatenate(sources)
+
+    def preprocess(self, X, y=None, sources=None):
+        pipe = pipeline.Pipeline(fuse(self.preproc_pipe))
+        return pipe.fit_transform(X), y, sources
 
     def _pipeline(self):
+        # steps with grid search parameters must keep their names
+        tuned = set(key.split('__')[0] for p in self.params for key in p)
         return pipeline.Pipeline(
-            self.extract_pipe + self.postproc_pipe +
+            fuse(self.extract_pipe + self.postproc_pipe, tuned) +
             [('classifier', self.classifier)])
 
     def _split_data(self, plants=None):
         # load plants if parameter is not provided
         if plants is None:
-            plants = plant.load_all()
+            plants = plant.load_store()
 
         # split plant data into training and validation sets
-        random.shuffle(plants)
-        train_len = int(0.75 * len(plants))
-        train_plants = plants[:train_len]
-        valid_plants = plants[train_len:]
-
-        # get X data and y labels
-        X_train, y_train, source_train = self.get_data(train_plants)
-        X_valid, y_valid, source_valid = self.get_data(valid_plants)
+        if isinstance(plants, store.PlantStore):
+            names = plants.names()
+        else:
+            names = [p.name for p in plants]
+        random.shuffle(names)
+        train_len = int(0.75 * len(names))
+
+        # preprocess every window once, then take each set by index
+        # preprocessing that learns from the data is fit on each set instead
+        X, y, sources = self.get_windows(plants)
+        stateless = self._stateless_preprocessing()
+        if stateless:
+            Xp, yp, sp = self._preprocess_all(X, y, sources)
+
+        def take_set(names):
+            indices = datapoint.plant_indices(sources, names)
+            # balance on the original labels, as preprocessing may change them
+            indices = indices[datapoint.balance_indices(y[indices], False)]
+            if not stateless:
+                return self._preprocess_all(X[indices], y[indices],
+                                            sources[indices])
+            return Xp[indices], yp[indices], sp[indices]
+
+        X_train, y_train, source_train = take_set(names[:train_len])
+        X_valid, y_valid, source_valid = take_set(names[train_len:])
         return X_train, X_valid, y_train, y_valid, source_train, source_valid
 
     def _run_classifier(self, split=True):
@@ -227,8 +279,10 @@ class Classifier:
         print "Classes in validation set:", class_valid
 
         # perform grid search on pipeline, get best parameters from training data
+        # folds hold out whole plants, so replicated windows never leak
+        folds = datapoint.plant_folds(st, 5)
         grid = grid_search.GridSearchCV(
-            self._pipeline(), self.params, cv=5, verbose=2)
+            self._pipeline(), self.params, cv=folds, verbose=2)
         grid.fit(X_train, y_train)
         classifier = grid.best_estimator_
 
@@ -247,22 +301,28 @@ class Classifier:
         # first, train classifier
         self._run_classifier(False)
 
-        for plant_data in plant.load_all():
-            X = []
-            coords = []
+        pipe = pipeline.Pipeline(fuse(self.extract_pipe + self.postproc_pipe))
+        skip = 512
+        stateless = self._stateless_preprocessing()
 
-            skip = 512
-
-            # take windows on data
-            for i in range(0, len(plant_data.readings)-datapoint.window_size, skip):
-                X.append(plant_data.readings[i:i+datapoint.window_size])
-                coords.append(i)
-
-            # transform and predict classes on all windows
-            pipe = pipeline.Pipeline(self.extract_pipe + self.postproc_pipe)
-            X = pipe.transform(self.preprocess(X)[0])
+        for plant_data in plant.load_store():
+            probs = []
+            coords = []
 
-            probs = self.classifier.predict_proba(X)
+            # transform and predict classes on sliding windows over the data
+            print "Preprocessing data"
+            # preprocessing that learns from the data is fit on the whole plant
+            batch = None if stateless else len(plant_data.readings)
+            for X, starts in datapoint.sliding_stream(plant_data.readings, skip,
+                                                      batch=batch):
+                X = pipe.transform(self.preprocess(X)[0])
+                probs.append(self.classifier.predict_proba(X))
+                coords += list(starts)
+
+            if not coords:
+                print "Skipping %s, too short for a window" % plant_data.name
+                continue
+            probs = np.concatenate(probs)
 
             # take classification as highest probability class
             classes = self.classifier.classes_
@@ -310,4 +370,4 @@ class InitClassifier(Classifier):
     """ Treats initial stimulus applications as separate classes. """
 
     def _gen_datapoints(self, plants):
-        return datapoint.generate_all(plants, split_initial=True)
+        return datapoint.generate_stream(plants, split_initial=True)
@@ -1,4 +1,290 @@
+import atexit
+import copy_reg
+import cPickle
 import multiprocessing
+import os
+import sys
+import tempfile
+import traceback
+import types
+
+import numpy
+
+# number of workers used when not given, None for the number of CPUs
+default_nprocs = None
+
+# number of chunks given to each worker per call, more chunks balance uneven
+# work between workers but cost more messages
+chunks_per_worker = 4
+
+# directory of the buffers arrays are passed through, /dev/shm is in memory
+shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+# module settings read by functions in the workers, such as extractors
+# they are sent with every call, as workers only see the settings of the time
+# the pool started
+worker_settings = [('plant', 'dtype'), ('datapoint', 'window_size'),
+                   ('datapoint', 'window_offset'), ('datapoint', 'null_offset')]
+
+# the pool reused by every call to parmap, started on first use
+_pool = None
+
+# true inside a pool worker, where parmap runs serially
+_in_worker = False
+
+
+def _reduce_method(m):
+    # bound methods (e.g. an extractor's) can't be pickled by default
+    if m.im_self is None:
+        return getattr, (m.im_class, m.im_func.__name__)
+    return getattr, (m.im_self, m.im_func.__name__)
+
+copy_reg.pickle(types.MethodType, _reduce_method)
+
+
+class Unpicklable(Exception):
+    """ Raised when a function can't be sent to the workers of a Pool. """
+
+
+def parmap(f, X, nprocs=None):
+    """
+    Apply a function to every item in parallel.
+
+    A pool of workers is kept between calls. Arrays are passed to and from
+    the workers through shared memory in chunks, rather than pickled one
+    item at a time. The worker_settings of this process are applied in the
+    workers for every call. Functions that can't be pickled, such as lambdas,
+    fall back to processes forked for the call.
+
+    Args:
+        f: The function to apply.
+        X: A list or array of items.
+        nprocs: The number of workers, defaults to default_nprocs.
+    Returns:
+        The result for every item in order, as an array if they are arrays of
+        the same shape, otherwise as a list.
+    """
+    nprocs = nprocs or default_nprocs or multiprocessing.cpu_count()
+    if _in_worker or nprocs == 1:
+        return [f(x) for x in X]
+
+    if not isinstance(X, numpy.ndarray):
+        X = list(X)
+    if len(X) == 0:
+        return []
+
+    try:
+        return _get_pool(nprocs).map(f, X)
+    except Unpicklable:
+        return queue_map(f, X, nprocs)
+
+
+def _get_pool(nprocs):
+    """ Returns: The shared Pool with nprocs workers, started if needed. """
+    global _pool
+    # a pool can only be used by the process that started it
+    if _pool is None or _pool.nprocs != nprocs or _pool.pid != os.getpid():
+        if _pool is not None and _pool.pid == os.getpid():
+            _pool.close()
+        _pool = Pool(nprocs)
+    return _pool
+
+
+@atexit.register
+def _close_pool():
+    if _pool is not None and _pool.pid == os.getpid():
+        _pool.close()
+
+
+class Pool:
+    """ Worker processes that are kept alive between calls. """
+
+    def __init__(self, nprocs):
+        self.nprocs = nprocs
+        self.pid = os.getpid()
+        self.calls = 0
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+
+        self.procs = [multiprocessing.Process(target=_work,
+                                              args=(self.tasks, self.results))
+                      for _ in range(nprocs)]
+        for p in self.procs:
+            p.daemon = True
+            p.start()
+
+    def map(self, f, X):
+        """
+        Apply a function to every item, in chunks spread over the workers.
+
+        Raises:
+            Unpicklable: If the function can't be sent to the workers.
+        """
+        try:
+            f_data = cPickle.dumps(f, cPickle.HIGHEST_PROTOCOL)
+        except (cPickle.PicklingError, TypeError, AttributeError):
+            raise Unpicklable(f)
+
+        self.calls += 1
+        settings = _settings()
+        size = -(-len(X) // (self.nprocs * chunks_per_worker))
+        bounds = range(0, len(X), size)
+
+        # equally shaped arrays are shared, anything else is pickled
+        shared = _write(X)
+        try:
+            for lo in bounds:
+                hi = min(len(X), lo + size)
+                if shared is None:
+                    data = ('items', X[lo:hi])
+                else:
+                    data = ('shared',) + shared + (lo, hi)
+                self.tasks.put((self.calls, f_data, settings, lo, data))
+
+            # always collect every chunk, so no results are left for later calls
+            chunks = {}
+            errors = []
+            while len(chunks) + len(errors) < len(bounds):
+                call, lo, ok, out = self.results.get()
+                if call != self.calls:
+                    # left over from a call that was interrupted
+                    if ok:
+                        _discard(out)
+                elif ok:
+                    chunks[lo] = out
+                else:
+                    errors.append(out)
+        finally:
+            if shared is not None:
+                os.remove(shared[0])
+
+        parts = [_read(chunks[lo]) for lo in bounds if lo in chunks]
+        if errors:
+            if any(kind == 'unpickle' for kind, _ in errors):
+                raise Unpicklable(f)
+            raise RuntimeError("parmap worker failed:\n" + errors[0][1])
+
+        arrays = [p for p in parts if isinstance(p, numpy.ndarray)]
+        if (len(arrays) == len(parts) and
+                len(set(a.shape[1:] for a in arrays)) == 1):
+            return numpy.concatenate(arrays)
+        return [x for p in parts for x in p]
+
+    def close(self):
+        """ Stop all workers. """
+        for _ in self.procs:
+            self.tasks.put(None)
+        for p in self.procs:
+            p.join()
+        self.procs = []
+
+
+def _work(tasks, results):
+    """ Run chunks of a pool until told to stop. """
+    global _in_worker
+    _in_worker = True
+
+    # the function of the current call, unpickled once per call
+    current = None
+    f = None
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        call, f_data, settings, lo, data = task
+
+        if call != current:
+            for module, name, value in settings:
+                module = sys.modules.get(module) or __import__(module)
+                setattr(module, name, value)
+            try:
+                f = cPickle.loads(f_data)
+                current = call
+            except Exception:
+                # e.g. a class defined in __main__ after the pool started
+                results.put((call, lo, False,
+                             ('unpickle', traceback.format_exc())))
+                continue
+
+        try:
+            if data[0] == 'shared':
+                name, dtype, shape, lo, hi = data[1:]
+                X = numpy.memmap(name, dtype, 'r', shape=shape)[lo:hi]
+                # a plain view, as memmap slices are slow to create per item
+                X = numpy.asarray(X)
+            else:
+                X = data[1]
+            out = [f(x) for x in X]
+            results.put((call, lo, True, _write(out) or ('items', out)))
+        except Exception:
+            results.put((call, lo, False, ('call', traceback.format_exc())))
+
+
+def _settings():
+    """ Returns: A list of (module, name, value) of worker_settings. """
+    # modules that were never imported still have their defaults
+    return [(module, name, getattr(sys.modules[module], name))
+            for module, name in worker_settings if module in sys.modules]
+
+
+def _write(X):
+    """
+    Copy equally shaped numeric arrays into a new shared buffer. A list of
+    arrays (e.g. windows) is copied one array at a time.
+
+    Returns:
+        The name, type and shape of the buffer, or None if the items can't be
+        shared or the buffer can't be written.
+    """
+    if not all(isinstance(x, numpy.ndarray) for x in X):
+        try:
+            X = numpy.asarray(X)
+        except ValueError:
+            # items of different shapes
+            return None
+
+    if isinstance(X, numpy.ndarray):
+        dtype, shape, parts = X.dtype, X.shape, [X]
+    else:
+        dtype, shape, parts = X[0].dtype, (len(X),) + X[0].shape, X
+        if any(x.dtype != dtype or x.shape != shape[1:] for x in X):
+            return None
+
+    if dtype.kind not in 'biufc' or len(shape) < 2 or 0 in shape:
+        return None
+
+    name = None
+    try:
+        fd, name = tempfile.mkstemp(prefix='parmap-', dir=shm_dir)
+        with os.fdopen(fd, 'wb') as f:
+            for part in parts:
+                numpy.ascontiguousarray(part).tofile(f)
+    except (IOError, OSError):
+        # e.g. shm_dir is full, the items are pickled instead
+        if name is not None:
+            os.remove(name)
+        return None
+    return name, dtype.str, shape
+
+
+def _read(chunk):
+    """ Returns: The items of a chunk of results, removing any shared buffer. """
+    if chunk[0] == 'items':
+        return chunk[1]
+
+    name, dtype, shape = chunk
+    try:
+        return numpy.fromfile(name, dtype).reshape(shape)
+    finally:
+        os.remove(name)
+
+
+def _discard(chunk):
+    """ Remove any shared buffer of a chunk of results that is not wanted. """
+    if chunk[0] != 'items' and os.path.exists(chunk[0]):
+        os.remove(chunk[0])
+
 
 # http://stackoverflow.com/a/16071616
 # by klaus se
@@ -9,10 +295,14 @@ def fun(f, q_in, q_out):
         i, x = q_in.get()
         if i is None:
             break
-        q_out.put((i, f(x)))
+        # send errors back, the caller would otherwise wait for ever
+        try:
+            q_out.put((i, True, f(x)))
+        except Exception:
+            q_out.put((i, False, traceback.format_exc()))
 
 
-def parmap(f, X, nprocs=multiprocessing.cpu_count()):
+def queue_map(f, X, nprocs=multiprocessing.cpu_count()):
     q_in = multiprocessing.Queue(1)
     q_out = multiprocessing.Queue()
 
@@ -28,4 +318,7 @@ def parmap(f, X, nprocs=multiprocessing.cpu_count()):
 
     [p.join() for p in proc]
 
-    return [x for i, x in sorted(res)]
+    errors = [out for i, ok, out in sorted(res) if not ok]
+    if errors:
+        raise RuntimeError("parmap worker failed:\n" + errors[0])
+    return [x for i, ok, x in sorted(res)]
@@ -1,23 +1,48 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from fractions import Fraction
 import scipy.io
 import numpy
 import os
+import re
 import csv
-import cPickle
-from scipy.signal import decimate
-
-stim_types = {
-    'water': ['acqua piante'],
-    'H2SO4': ['h2so4'],
-    'ozone': ['ozone', 'ozono', 'o3'],
-    'NaCL': ['nacl'],
-    'light-on': ['light-on'],
-    'light-off': ['light-off']
-}
+import multiprocessing
+import warnings
+from scipy.signal import firwin, upfirdn
+
+import instrument
+import store
+
+try:
+    import h5py
+except ImportError:
+    # only needed for MATLAB v7.3 files
+    h5py = None
+
+# aliases of each stimulus type in marker names, in order of priority
+# when a marker name matches aliases of more than one type
+stim_types = OrderedDict([
+    ('water', ['acqua piante']),
+    ('H2SO4', ['h2so4']),
+    ('ozone', ['ozone', 'ozono', 'o3']),
+    ('NaCL', ['nacl']),
+    ('light-on', ['light-on']),
+    ('light-off', ['light-off'])
+])
+
+# markers containing this mark the end of a stimulus
+stim_stop = 'stop'
 
 # the ideal sample frequency to sample the plant data at
 ideal_freq = 0.1
 
+# type of stored readings, and so of the windows and transforms on them
+# numpy.float32 halves memory and bandwidth, see benchmark.float32_scores
+# set before loading any plants, stores in another type are rebuilt
+dtype = numpy.float64
+
+# name of the matrix of readings in .mat files
+mat_readings_name = 'b\x001\x00\x00\x00'
+
 # a stimulus on the plant, defined as a type (such as 'ozone') and time
 # the null (no) stimulus is named 'null'
 Stimulus = namedtuple('Stimulus', ['type', 'time'])
@@ -27,46 +52,211 @@ Stimulus = namedtuple('Stimulus', ['type', 'time'])
 PlantData = namedtuple('PlantData',
                        ['name', 'readings', 'stimuli', 'sample_freq'])
 
-# pre-loaded plant data
-_plant_data = None
+# summary of the data files in an experiment directory, see fingerprint()
+Fingerprint = namedtuple('Fingerprint', ['mtime', 'size', 'blocks'])
+
+# name of the plant store directory, relative to the data directory
+store_name = "plant_store"
+
+# largest denominator used to express a change in sample rate as a fraction
+max_resample_ratio = 1000
+
+# largest factor readings are upsampled by to reach ideal_freq, plants read
+# more slowly (e.g. with a period given as their SPEED) are skipped
+max_upsample = 10
 
+# number of readings resampled at a time, bounds the memory used by resample
+chunk_size = 65536
 
-def load_all(path="."):
+# opened plant stores by data directory
+_stores = {}
+
+# compiled stimulus matcher and the stim_types it was compiled from
+_stim_matcher = None
+
+
+def load_all(path=".", workers=None):
     """
-    Load all plant data from .txt files.
+    Load all plant data from .txt and .mat files.
+    Prefer load_store, which only opens the plants that are used.
 
     Args:
         path: Path to a directory.
-    Returns: A list of PlantData
+        workers: Number of processes used to read experiment directories.
+    Returns: A list of PlantData, ordered by experiment directory.
     """
+    return list(load_store(path, workers))
 
-    # first check if data has already been loaded (for super-quick loading!)
-    global _plant_data
-    if _plant_data:
-        return _plant_data
 
-    # first check for previously generated plant data (for quicker loading)
-    plant_file = os.path.join(path, "plant_data")
-    if os.path.isfile(plant_file):
-        with file(plant_file, 'r') as f:
-            print "Loading from generated file %s" % plant_file
-            _plant_data = cPickle.load(f)
-            return _plant_data
+def load_store(path=".", workers=None, report=None):
+    """
+    Load plant data from .txt and .mat files into a store and open it.
 
-    plants = []
+    The parsed data is cached in a binary store (see store.py), so later calls
+    only read the small store index, and readings are memory-mapped when a
+    plant is used. Every experiment directory and .mat file is fingerprinted,
+    and only experiments that were added or changed since the store was
+    written are read again.
 
-    for root, dirs, files in os.walk(path):
-        if "blk0" in dirs:
-            print "Reading %s" % root
-            plants += load_txt(root)
+    Args:
+        path: Path to a directory.
+        workers:
+            Number of processes used to read experiment directories,
+            defaults to the number of CPUs.
+        report:
+            File to write a JSON report to, with the time, bytes, rows and
+            peak memory of every loading stage for every experiment. The
+            store is checked again even if it was already opened.
+    Returns: A PlantStore, ordered by experiment directory.
+    """
 
-    # save generated plant data to pickle file for faster loading
-    print "Writing to pickle file"
-    with file(plant_file, 'w') as f:
-        cPickle.dump(plants, f)
+    # first check if the store has already been opened (for super-quick loading!)
+    # unless a report is wanted, which needs the stages to be run again
+    if path in _stores and report is None:
+        return _stores[path]
+
+    store_path = os.path.join(path, store_name)
+    _, sources = store.read_index(store_path) or ([], {})
+
+    if report is not None:
+        instrument.enable()
+
+    # find every experiment and check if it is already in the store
+    found = {}
+    with instrument.stage('scan'):
+        for root, dirs, files in os.walk(path):
+            if "blk0" in dirs:
+                found[os.path.relpath(root, path)] = fingerprint(root)
+            for fname in files:
+                if fname.endswith(".mat"):
+                    mat = os.path.join(root, fname)
+                    found[os.path.relpath(mat, path)] = fingerprint(mat)
+
+    new_sources = sorted(s for s in found if sources.get(s) != found[s])
+    removed = [source for source in sources if source not in found]
+
+    # read new and changed directories straight into the store in parallel
+    changed = {}
+    if new_sources:
+        store.create(store_path)
+        tasks = [(path, source, store_path) for source in new_sources]
+        results = _imap(_ingest, tasks, workers)
+        for i, (source, new_entries, records) in enumerate(results):
+            instrument.add(records)
+            if new_entries is None:
+                print "[%d/%d] Skipped %s" % (
+                    i + 1, len(tasks), os.path.join(path, source))
+                continue
+            print "[%d/%d] Read %s (%d plants)" % (
+                i + 1, len(tasks), os.path.join(path, source), len(new_entries))
+            changed[source] = (found[source], new_entries)
+
+    # merge new and changed directories into the store index
+    if changed or removed:
+        print "Updating plant store %s" % store_path
+        with instrument.stage('update_index'):
+            store.update(store_path, changed, removed)
+    else:
+        print "Loading from plant store %s" % store_path
+
+    if report is not None:
+        instrument.report(report)
+        instrument.disable()
+
+    _stores[path] = store.PlantStore(store_path)
+    return _stores[path]
+
+
+def _ingest(task):
+    """
+    Read an experiment directory or .mat file and write its plants into a
+    store.
+    Run in a worker process by load_store.
 
-    _plant_data = plants
-    return _plant_data
+    Args:
+        task: A tuple of the data path, experiment and store path.
+    Returns:
+        A tuple of the experiment, a list of store Entry (or None if it is a
+        .mat file that can't be read) and the instrument records of reading
+        the experiment.
+    """
+    path, source, store_path = task
+    experiment = os.path.join(path, source)
+
+    # workers may have inherited records from the parent, don't send them back
+    since = instrument.mark()
+    instrument.experiment = source
+
+    if not experiment.endswith(".mat"):
+        plants = load_txt(experiment)
+    else:
+        try:
+            if is_plant_mat(experiment):
+                plants = load_mat(experiment)
+            else:
+                # other MATLAB data, remember it so it isn't checked again
+                plants = []
+        except Exception, e:
+            # any .mat file in the data directory is read, so one that can't
+            # be is left out of the store and tried again next time
+            print "Skipping %s: %s" % (experiment, e)
+            instrument.experiment = None
+            return source, None, instrument.collect(since)
+
+    with instrument.stage('write_store') as counts:
+        entries = [store.write_plant(store_path, p, source) for p in plants]
+        counts['bytes'] = sum(p.readings.nbytes for p in plants)
+
+    instrument.experiment = None
+    return source, entries, instrument.collect(since)
+
+
+def _imap(f, tasks, workers=None):
+    """
+    Apply a function to every task over a process pool, yielding results as
+    they complete. With a single worker, tasks are run in this process.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    if workers == 1 or len(tasks) == 1:
+        for task in tasks:
+            yield f(task)
+        return
+
+    pool = multiprocessing.Pool(min(workers, len(tasks)))
+    try:
+        for result in pool.imap_unordered(f, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def fingerprint(path):
+    """
+    Summarise the data files of an experiment, to detect changes.
+
+    Args:
+        path: Path to a data folder or .mat file.
+    Returns: A Fingerprint of the folder.
+    """
+    # .mat files are a single block
+    if os.path.isfile(path):
+        st = os.stat(path)
+        return Fingerprint(st.st_mtime, st.st_size, 1)
+
+    mtime = 0
+    size = 0
+
+    i = 0
+    while os.path.exists(os.path.join(path, "blk%d" % i)):
+        blk = os.path.join(path, "blk%d" % i)
+        for fname in os.listdir(blk):
+            st = os.stat(os.path.join(blk, fname))
+            mtime = max(mtime, st.st_mtime)
+            size += st.st_size
+        i += 1
+
+    return Fingerprint(mtime, size, i)
 
 
 def load_txt(path):
@@ -102,29 +292,19 @@ def load_txt(path):
 
         marks = os.path.join(blk, "marks.txt")
 
-        with file(marks, 'r') as f:
-            reader = csv.reader(f, delimiter=',')
-            next(reader)  # skip header
-            for row in reader:
-                stimuli.append(Stimulus(row[0].strip(),
-                                        int(row[2].strip()) + mark_offset))
-
-        with file(data, 'r') as f:
-            reader = csv.reader(f, delimiter='\t')
-
-            for row in reader:
-                new_data = row[:-1]  # skip last column
-
-                # skip empty rows
-                if len(new_data) == 0:
-                    continue
+        with instrument.stage('read') as counts:
+            with file(marks, 'r') as f:
+                reader = csv.reader(f, delimiter=',')
+                next(reader)  # skip header
+                for row in reader:
+                    stimuli.append(Stimulus(row[0].strip(),
+                                            int(row[2].strip()) + mark_offset))
+            counts['bytes'] = os.path.getsize(marks)
 
-                try:
-                    raw_data.append(map(float, new_data))
-                    mark_offset += 1
-                except ValueError:
-                    # catch case where looking at header
-                    pass
+        block = load_block(data)
+        if len(block) > 0:
+            raw_data.append(block)
+            mark_offset += len(block)
 
         i += 1
 
@@ -133,46 +313,240 @@ def load_txt(path):
     if fname == 'Electrical signal':
         fname = os.path.basename(os.path.split(path)[0])
 
-    return format_raw(fname, raw_data, stimuli, sample_freq)
+    if raw_data:
+        readings = numpy.concatenate(raw_data)
+    else:
+        readings = numpy.empty((0, 0))
+
+    return format_raw(fname, readings, stimuli, sample_freq)
+
+
+def load_block(path):
+    """
+    Read a tab-separated block data file in bulk.
+    Header rows and the last column are skipped, as in _load_block_rows.
+
+    Args:
+        path: Path to a data.txt or data2.txt file.
+    Returns: A 2D array of readings, one row per sample.
+    """
+    with instrument.stage('read') as counts:
+        with file(path, 'rb') as f:
+            text = f.read()
+        counts['bytes'] = len(text)
+
+    with instrument.stage('parse') as counts:
+        readings = _parse_block(text, path)
+        counts['rows'] = len(readings)
+
+    return readings
+
+
+def _parse_block(text, path):
+    """
+    Parse the contents of a block data file, see load_block.
+
+    Args:
+        text: The contents of the file.
+        path: Path to the file, to read it row by row if it is irregular.
+    Returns: A 2D array of readings, one row per sample.
+    """
+    # skip header rows until the first row of numbers
+    start = 0
+    while start < len(text):
+        end = text.find('\n', start)
+        if end == -1:
+            end = len(text)
+        row = text[start:end].rstrip('\r').split('\t')
+        try:
+            if len(row) > 1:
+                map(float, row[:-1])
+                break
+        except ValueError:
+            pass
+        start = end + 1
+
+    body = text[start:].rstrip()
+    if not body:
+        return numpy.empty((0, 0))
+
+    # the last column is parsed too if it isn't empty, then dropped
+    num_cols = len(row) - 1
+    row_size = num_cols + (1 if row[-1].strip() else 0)
+    num_rows = body.count('\n') + 1
+
+    # parse every number in one go, this stops early on any non-numeric value
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        values = numpy.fromstring(body, sep=' ')
+
+    if len(values) != num_rows * row_size:
+        # rows are ragged, empty or interleaved with headers
+        return _load_block_rows(path)
+
+    readings = values.reshape((num_rows, row_size))
+    if row_size != num_cols:
+        readings = numpy.ascontiguousarray(readings[:, :num_cols])
+    return readings
+
+
+def _load_block_rows(path):
+    """
+    Read a tab-separated block data file row by row.
+    Slow, but copes with any mix of header, empty and data rows.
+
+    Args:
+        path: Path to a data.txt or data2.txt file.
+    Returns: A 2D array of readings, one row per sample.
+    """
+    raw_data = []
+
+    with file(path, 'r') as f:
+        reader = csv.reader(f, delimiter='\t')
+
+        for row in reader:
+            new_data = row[:-1]  # skip last column
+
+            # skip empty rows
+            if len(new_data) == 0:
+                continue
+
+            try:
+                raw_data.append(map(float, new_data))
+            except ValueError:
+                # catch case where looking at header
+                pass
+
+    if not raw_data:
+        return numpy.empty((0, 0))
+    return numpy.array(raw_data)
 
 
 def load_mat(path):
     """
     Load plant data from a .mat file.
+    Only the readings matrix and the stimulus markers are read from the file.
+    MATLAB v7.3 files are read through h5py, a chunk of readings at a time.
 
     Args:
         path: Path to a .mat file.
     Returns: A list of PlantData
     """
-    mat = scipy.io.loadmat(path)
-
-    # get astonishingly poorly-named matrix of readings
-    readings = mat['b\x001\x00\x00\x00']
+    with instrument.stage('read') as counts:
+        variables = mat_variables(path)
+        name = _mat_readings_name(variables)
+        markers = _mat_marker_names(variables)
+
+        if _is_hdf5(path):
+            readings, marks = _read_mat_hdf5(path, name, markers)
+        else:
+            mat = scipy.io.loadmat(path, variable_names=[name] + markers)
+            readings = mat[name]
+            # get name and time value of stimulus in terrifyingly deep array WTF
+            marks = [(mat[m][0][0][1][0], mat[m][0][0][0][0][0])
+                     for m in markers]
+
+        counts['bytes'] = os.path.getsize(path)
+        counts['rows'] = len(readings)
 
     # calculate sample frequency
     total_time = readings[-1][0] - readings[0][0]
     sample_freq = total_time / len(readings)
     # TODO: Worry about when the sample frequency is different (interpolate?)
 
-    # get all labelled stimuli
-    stimuli = []
-    i = 0
-    while 'm%03d' % i in mat:
-        # get name and time value of stimulus in terrifyingly deep array WTF
-        stim_data = mat['m%03d' % i]
-        name = stim_data[0][0][1][0]
-        time = stim_data[0][0][0][0][0]
+    # calculate index of readings array from time and time step per reading
+    stimuli = [Stimulus(stim, time / sample_freq) for stim, time in marks]
 
-        # calculate index of readings array from time and time step per reading
-        index = time / sample_freq
+    fname = os.path.basename(path)
 
-        stimuli.append(Stimulus(name, index))
+    return format_raw(fname, readings[:, 1:], stimuli, sample_freq)
 
-        i += 1
 
-    fname = os.path.basename(path)
+def is_plant_mat(path):
+    """ Returns: True if a .mat file contains plant readings. """
+    return _mat_readings_name(mat_variables(path)) is not None
 
-    return format_raw(fname, readings[:, 1:], stimuli, sample_freq)
+
+def mat_variables(path):
+    """
+    List the variables in a .mat file without reading their data.
+
+    Args:
+        path: Path to a .mat file.
+    Returns: A dictionary of variable shapes by name.
+    Raises:
+        ImportError: If it is a v7.3 file and h5py is not installed.
+    """
+    if not _is_hdf5(path):
+        return dict((name, shape) for name, shape, _ in scipy.io.whosmat(path))
+    if h5py is None:
+        raise ImportError("h5py is required to read MATLAB v7.3 file %s" % path)
+
+    # MATLAB stores arrays transposed in HDF5
+    with h5py.File(path, 'r') as f:
+        return dict((name, getattr(f[name], 'shape', ())[::-1])
+                    for name in f if not name.startswith('#'))
+
+
+def _mat_marker_names(variables):
+    """ Returns: The names of all stimulus marker structs, in order. """
+    markers = []
+    while 'm%03d' % len(markers) in variables:
+        markers.append('m%03d' % len(markers))
+    return markers
+
+
+def _mat_readings_name(variables):
+    """ Returns: The name of the readings matrix, or None if there isn't one. """
+    # get astonishingly poorly-named matrix of readings
+    if mat_readings_name in variables:
+        return mat_readings_name
+
+    # otherwise, files with markers have the readings in their largest matrix
+    if not _mat_marker_names(variables):
+        return None
+    matrices = [(numpy.prod(shape), name)
+                for name, shape in variables.iteritems() if len(shape) == 2]
+    return max(matrices)[1] if matrices else None
+
+
+def _is_hdf5(path):
+    """ Returns: True if a .mat file is a MATLAB v7.3 (HDF5) file. """
+    if h5py is not None:
+        return h5py.is_hdf5(path)
+    # v7.3 files have the HDF5 signature after a 512 byte MATLAB header
+    with file(path, 'rb') as f:
+        f.seek(512)
+        return f.read(8) == '\x89HDF\r\n\x1a\n'
+
+
+def _read_mat_hdf5(path, name, markers):
+    """
+    Read the readings matrix and stimulus markers from a MATLAB v7.3 file.
+
+    Args:
+        path: Path to a .mat file.
+        name: Name of the readings matrix.
+        markers: Names of the stimulus marker structs.
+    Returns: The readings and a list of (name, time) for every marker.
+    """
+    with h5py.File(path, 'r') as f:
+        # read transposed readings a chunk at a time, to avoid a second copy
+        data = f[name]
+        readings = numpy.empty(data.shape[::-1])
+        for start in range(0, len(readings), chunk_size):
+            end = start + chunk_size
+            readings[start:end] = data[:, start:end].T
+
+        marks = []
+        for m in markers:
+            # name and time are the second and first fields of the struct
+            fields = [''.join(field) for field in f[m].attrs['MATLAB_fields']]
+            chars = f[m][fields[1]][()].ravel()
+            stim = ''.join(unichr(c) for c in chars).encode('utf-8')
+            marks.append((stim, f[m][fields[0]][()].ravel()[0]))
+
+    return readings, marks
 
 
 def format_raw(name, raw_data, raw_stimuli, sample_freq):
@@ -185,56 +559,210 @@ def format_raw(name, raw_data, raw_stimuli, sample_freq):
         raw_stimuli: A list of Stimulus which are not necessarily valid.
     Returns: A list of PlantData
     """
-    stimuli = []
+    with instrument.stage('format_raw') as counts:
+        readings = numpy.asarray(raw_data)
+        stimuli = classify_stimuli(raw_stimuli)
+        counts['rows'] = len(readings)
 
-    readings = numpy.array(raw_data)
-    print readings.shape
+    # for every pair of readings, create a plant data object
+    # each pair is a view, resample only copies it a chunk at a time
+    plants = []
+    for i in range(readings.shape[1] / 2):
+        data = readings[:, 2*i:2*i+2]
+        plant = PlantData("%s_%d" % (name, i), data, stimuli, sample_freq)
+        try:
+            plant = resample(plant, ideal_freq)
+        except ValueError, e:
+            print "Skipping %s: %s" % (plant.name, e)
+            continue
+        plants.append(plant)
 
-    for stim in raw_stimuli:
-        # find type of stimulus
-        type_ = None
+    return plants
 
-        if 'stop' in stim.type.lower():
-            # this is the end of a stimulus, don't use
-            continue
 
-        for t, aliases in stim_types.iteritems():
-            for alias in aliases:
-                if alias in stim.type.lower():
-                    type_ = t
-                    break
+def register_stimulus(type_, aliases):
+    """
+    Add aliases for a stimulus type, so they are recognized in marker names.
+    New types have a lower priority than all existing types.
+    Plants already in a plant store keep the stimuli they were read with.
 
-            if type_:
-                break
+    Args:
+        type_: The stimulus type, such as 'ozone'.
+        aliases: Strings that identify the type in marker names, in any case.
+    """
+    known = stim_types.setdefault(type_, [])
+    known += [a.lower() for a in aliases if a.lower() not in known]
 
-        # if type recognized, add to stimuli
-        if type_ is not None:
-            stimuli.append(Stimulus(type_, stim.time))
 
-    # for every pair of readings, create a plant data object
-    plants = []
-    for i, (r1, r2) in enumerate(zip(readings.T[0::2], readings.T[1::2])):
-        data = numpy.array([r1, r2]).T
-        plant = PlantData("%s_%d" % (name, i), data, stimuli, sample_freq)
-        plant = resample(plant, ideal_freq)
-        plants.append(plant)
+def classify_stimuli(raw_stimuli):
+    """
+    Find the type of every stimulus from its marker name.
+    A marker matching aliases of several types is given the first type in
+    stim_types.
 
-    return plants
+    Args:
+        raw_stimuli: A list of Stimulus named after their markers.
+    Returns: A list of Stimulus of recognized types, without stop markers.
+    """
+    regex, types = _compile_stimuli()
+
+    stimuli = []
+    for stim in raw_stimuli:
+        m = regex.match(stim.type.lower())
+        if m is not None and m.lastgroup is not None:
+            stimuli.append(Stimulus(types[m.lastgroup], stim.time))
+
+    return stimuli
+
+
+def _compile_stimuli():
+    """
+    Returns:
+        A regular expression matching marker names and a dictionary of
+        stimulus types by the name of the group matched for each type.
+        Only recompiled when stim_types changes.
+    """
+    global _stim_matcher
+
+    key = [(t, tuple(aliases)) for t, aliases in stim_types.iteritems()]
+    if _stim_matcher is None or _stim_matcher[0] != key:
+        # one look-ahead per type, tried in priority order
+        groups = ['(?=.*(?:%s))(?P<t%d>)' % (
+                      '|'.join(re.escape(a.lower()) for a in aliases), i)
+                  for i, (t, aliases) in enumerate(key) if aliases]
+        regex = re.compile('(?!.*%s)(?:%s)' % (re.escape(stim_stop),
+                                               '|'.join(groups)), re.DOTALL)
+        types = dict(('t%d' % i, t) for i, (t, aliases) in enumerate(key))
+        _stim_matcher = (key, regex, types)
+
+    return _stim_matcher[1:]
 
 
 def resample(plant_data, new_sample_freq):
     """
-    Resample some plant data to a new, lower sampling frequency.
+    Resample some plant data to a new sampling frequency.
+    Note that sampling 'frequencies' here are the time between readings.
+
+    Integer decimation factors use an FIR decimation filter, any other ratio
+    uses a polyphase rational resampler. Either way the cost is linear in the
+    number of readings.
 
     Args:
         plant_data: The plant data to resample.
-        sample_freq: The new frequency, must not be higher than the current frequency.
+        sample_freq: The new frequency.
     Returns: A new plant data at the new frequency.
+    Raises:
+        ValueError: If the readings would be upsampled by over max_upsample.
     """
-    if new_sample_freq <= plant_data.sample_freq:
+    if new_sample_freq == plant_data.sample_freq:
         return plant_data
 
-    dec_factor = int(new_sample_freq / plant_data.sample_freq)
-    readings = decimate(plant_data.readings, dec_factor, ftype='fir', axis=0)
-    stimuli = [Stimulus(s.type, s.time / dec_factor) for s in plant_data.stimuli]
+    # express the change in rate as a fraction of small integers
+    ratio = Fraction(plant_data.sample_freq / new_sample_freq)
+    ratio = ratio.limit_denominator(max_resample_ratio)
+    up, down = ratio.numerator, ratio.denominator
+
+    if up > down * max_upsample:
+        raise ValueError(
+            "sample frequency %g is %.0fx slower than %g, more than "
+            "max_upsample (%d)" % (plant_data.sample_freq, float(ratio),
+                                   new_sample_freq, max_upsample))
+
+    with instrument.stage('resample') as counts:
+        if up == down:
+            readings = plant_data.readings
+        elif up == 1:
+            readings = decimate_stream(plant_data.readings, down)
+        else:
+            readings = resample_stream(plant_data.readings, up, down)
+        counts['rows'] = len(plant_data.readings)
+
+    stimuli = [Stimulus(s.type, s.time * up / down) for s in plant_data.stimuli]
     return PlantData(plant_data.name, readings, stimuli, new_sample_freq)
+
+
+def decimate_stream(readings, factor, chunk=None):
+    """
+    Decimate readings with a low-pass FIR filter, one chunk at a time.
+
+    The result is the same as scipy.signal.decimate(readings, factor,
+    ftype='fir', axis=0), up to floating point rounding (differences are below
+    1e-12 of the signal size).
+
+    Args:
+        readings: A 2D array of readings, one row per sample.
+        factor: The integer decimation factor.
+        chunk: Number of readings filtered at a time, defaults to chunk_size.
+    Returns: A 2D array of the decimated readings.
+    """
+    # same filter as decimate
+    taps = firwin(20 * factor + 1, 1. / factor, window='hamming')
+    return resample_stream(readings, 1, factor, taps, chunk)
+
+
+def resample_stream(readings, up, down, taps=None, chunk=None):
+    """
+    Resample readings by a rational factor with a polyphase FIR filter, one
+    chunk at a time.
+
+    The filter state (the last readings of the previous chunk) is carried over
+    between chunks, so only a chunk of the readings is copied at once, and
+    only the kept outputs are ever computed. The result is the same as
+    scipy.signal.resample_poly(readings, up, down, axis=0), up to floating
+    point rounding (differences are below 1e-12 of the signal size).
+
+    Args:
+        readings: A 2D array of readings, one row per sample.
+        up: The upsampling factor.
+        down: The downsampling factor.
+        taps:
+            The filter, centred on each output. Defaults to the Kaiser window
+            filter used by resample_poly.
+        chunk: Number of readings filtered at a time, defaults to chunk_size.
+    Returns: A 2D array of the resampled readings.
+    """
+    if taps is None:
+        max_rate = max(up, down)
+        taps = firwin(20 * max_rate + 1, 1. / max_rate, window=('kaiser', 5.0))
+    taps = taps * up
+    delay = (len(taps) - 1) / 2
+
+    # pad the filter so the centre of every output lands on a multiple of down
+    pad = -delay % down
+    taps = numpy.concatenate((numpy.zeros(pad), taps))
+
+    # chunks start on multiples of down, so every chunk has the same phase
+    chunk = chunk or chunk_size
+    chunk += -chunk % down
+
+    num_in = len(readings)
+    num_out = (num_in * up + down - 1) / down
+    resampled = numpy.empty((num_out,) + readings.shape[1:])
+
+    # readings before the start are zero, as are readings past the end
+    state_size = (len(taps) - pad + up - 2) / up
+    state_size += -state_size % down
+    state = numpy.zeros((state_size,) + readings.shape[1:])
+
+    # output k is centred on the upsampled reading at k*down + delay, which
+    # lies between the readings at (k*down + delay) / up and the next one
+    k = 0
+    total = ((num_out - 1) * down + delay) / up + 1 if num_out else 0
+    for start in range(0, total, chunk):
+        end = min(start + chunk, total)
+        block = numpy.zeros((end - start,) + readings.shape[1:])
+        block[:max(0, min(end, num_in) - start)] = readings[start:end]
+
+        # buffer[j] is the reading at start - state_size + j
+        buffer = numpy.concatenate((state, block))
+        state = buffer[len(buffer)-state_size:]
+
+        # filter only the outputs centred inside this chunk
+        k_end = min(num_out, (end * up - delay + down - 1) / down)
+        if k_end > k:
+            first = k + (delay + pad - (start - state_size) * up) / down
+            filtered = upfirdn(taps, buffer, up, down, axis=0)
+            resampled[k:k_end] = filtered[first:first+k_end-k]
+            k = k_end
+
+    return resampled
@@ -3,6 +3,7 @@ from transform import *
 from sda import SDA
 from sklearn import preprocessing, decomposition
 from itertools import chain
+from collections import Counter
 import scipy
 import random
 
@@ -466,16 +467,13 @@ def histogram_ben_separation():
     X_train, y_train = X[:cutoff], y[:cutoff]
     X_valid, y_valid = X[cutoff:], y[cutoff:]
 
-    # put flag inside a list to deal with weird scoping
-    train_set = [True]
+    # use the Matlab data in place of generated data
+    def split_data(_=None):
+        return X_train, X_valid, y_train, y_valid, sources, sources
 
-    # the second time this is called, return a different set of data
     def get_data(_=None):
-        if train_set[0]:
-            train_set[0] = False
-            return (X_train, y_train, sources)
-        else:
-            return (X_valid, y_valid, sources)
+        return X_valid, y_valid, sources
+    classifier._split_data = split_data
     classifier.get_data = get_data
     classifier.plot1d('Separation using Ben\'s histograms.')
     classifier.plot_lda_scaling(False, 'Significance of histogram features.')
@@ -579,7 +577,7 @@ def power_spectral_density_pca():
     2014-08-28
     Sum up power spectral density per-class to identify patterns.
     """
-    plants = plant.load_all()
+    plants = plant.load_store()
     X, y, sources = datapoint.generate_all(plants)
 
     # plot power spectral density of data in 2D
@@ -627,7 +625,7 @@ def calc_time_delay():
     Calculate time delay between electrode channels.
     Can be used to calculate propagation of response.
     """
-    plants = plant.load_all()
+    plants = plant.load_store()
     X, y, sources = datapoint.generate_all(plants)
 
     # mov_avg = Map(MovingAvg(256), divs=2)
@@ -680,3 +678,18 @@ def histogram_elec_separation():
     classifier = Classifier([('c', Concat()), ('p', Map(PostStimulus(), divs=2))],
                             features, postproc_standard, SDA(num_features=15))
     classifier.plot('Separation using histograms of electrode channels')
+
+
+def window_size_sweep():
+    """
+    2026-10-16
+    Count the data points of each class for a range of window sizes. Every
+    size is placed from the same schedule, so stimuli are only read once.
+    """
+    plants = plant.load_store()
+    schedule = datapoint.schedule(plants)
+
+    for size in [4096, 8192, 16384, 16384+4096, 32768]:
+        spec = datapoint.default_spec()._replace(size=size)
+        plant_index, starts, y = schedule.windows(spec)
+        print "Window size %d:" % size, dict(Counter(y))
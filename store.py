@@ -0,0 +1,289 @@
+""" Binary on-disk store of plant data.
+
+Every plant is kept as one contiguous .npy array of readings, so it can be
+memory-mapped on demand. A small index holds the names, stimuli and sample
+frequencies, so opening the store does not touch any readings.
+
+Arrays are mapped read-only, so any number of processes (e.g. parmap workers)
+can read the same store at once. Workers forked after the store is opened
+share the mapped pages instead of receiving copies of the readings.
+"""
+
+from collections import namedtuple, OrderedDict
+import cPickle
+import hashlib
+import os
+
+import numpy
+
+import plant
+
+# name of the index file inside a store directory
+index_name = "index"
+
+# version of the store layout, bumped whenever the index format or the way
+# plants are read changes, so old stores are rebuilt
+version = 5
+
+# default number of plants a PlantStore keeps open at once
+default_cache_size = 32
+
+# index information on a single plant, readings are kept in a separate file
+# source is the experiment directory the plant was read from
+Entry = namedtuple('Entry',
+                   ['name', 'stimuli', 'sample_freq', 'shape', 'file', 'source'])
+
+
+def read_index(path):
+    """
+    Read the index of a store.
+
+    Args:
+        path: Path to a store directory.
+    Returns:
+        A tuple of a list of Entry and a dictionary of fingerprints by source
+        directory, or None if there is no valid store at the path.
+    """
+    index_file = os.path.join(path, index_name)
+    if not os.path.isfile(index_file):
+        return None
+
+    with file(index_file, 'rb') as f:
+        index = cPickle.load(f)
+
+    if index.get('version') != version:
+        return None
+
+    # readings of another type are rebuilt, rather than converted on access
+    if index.get('dtype') != numpy.dtype(plant.dtype).str:
+        return None
+
+    return index['plants'], index['sources']
+
+
+def write_index(path, entries, sources=None):
+    """
+    Write the index of a store, replacing any existing index.
+
+    Args:
+        path: Path to a store directory.
+        entries: A list of Entry.
+        sources:
+            A dictionary of fingerprints by source directory, used to detect
+            which directories have changed since the store was written.
+    """
+    index = {'version': version, 'dtype': numpy.dtype(plant.dtype).str,
+             'plants': list(entries), 'sources': dict(sources or {})}
+
+    # write to a temporary file first so readers never see a partial index
+    index_file = os.path.join(path, index_name)
+    tmp_file = index_file + ".tmp"
+    with file(tmp_file, 'wb') as f:
+        cPickle.dump(index, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_file, index_file)
+
+
+def write_plant(path, plant_data, source=None):
+    """
+    Write the readings of a single plant into a store.
+
+    Args:
+        path: Path to a store directory.
+        plant_data: The PlantData to write.
+        source: The experiment directory the plant was read from.
+    Returns: The Entry describing the plant.
+    """
+    # plant names are only unique within a source, e.g. two experiments in
+    # folders with the same name
+    # every write goes to a new file, so the readings of the current index
+    # are never changed, even if the index is not updated after all
+    key = "%s\0%s" % (source or "", plant_data.name)
+    fname = "%s-%s.npy" % (hashlib.md5(key).hexdigest(),
+                           os.urandom(4).encode('hex'))
+    readings = numpy.ascontiguousarray(plant_data.readings, dtype=plant.dtype)
+    numpy.save(os.path.join(path, fname), readings)
+    return Entry(plant_data.name, list(plant_data.stimuli),
+                 plant_data.sample_freq, readings.shape, fname, source)
+
+
+def create(path):
+    """ Create an empty store directory, if it does not exist. """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+
+def update(path, changed, removed=()):
+    """
+    Merge re-read experiment directories into a store, keeping the readings of
+    every other directory untouched.
+
+    Args:
+        path: Path to a store directory.
+        changed:
+            A dictionary of (fingerprint, entries) by source directory, for
+            every directory that was added or has changed. The readings of the
+            entries must already be written with write_plant.
+        removed: Source directories that no longer exist.
+    Returns: A list of Entry.
+    """
+    create(path)
+
+    entries, sources = read_index(path) or ([], {})
+
+    # drop all plants from directories that are being replaced
+    dropped = set(changed) | set(removed)
+    entries = [e for e in entries if e.source not in dropped]
+    for source in removed:
+        sources.pop(source, None)
+
+    # plants already in the store keep their names
+    names = set(e.name for e in entries)
+    for source in sorted(changed):
+        fingerprint, new_entries = changed[source]
+        entries += _unique_names(new_entries, names)
+        sources[source] = fingerprint
+
+    # keep plants ordered by directory, as they would be from a full rebuild
+    entries.sort(key=lambda e: e.source)
+    write_index(path, entries, sources)
+    _remove_unused(path, entries)
+
+    return entries
+
+
+def _remove_unused(path, entries):
+    """
+    Remove readings that are not in the index, such as replaced plants and
+    plants written by an update that did not finish. Only call this after
+    the index is written.
+    Processes that still have removed readings mapped keep their copy.
+    """
+    used = set(e.file for e in entries)
+    for fname in os.listdir(path):
+        if fname.endswith(".npy") and fname not in used:
+            os.remove(os.path.join(path, fname))
+
+
+def _unique_names(entries, names):
+    """
+    Rename plants whose name is already taken, as plants are looked up by
+    name. A renamed plant is named after its source as well.
+
+    Args:
+        entries: A list of Entry.
+        names: The set of names taken, the new names are added to it.
+    Returns: A list of Entry with unique names.
+    """
+    unique = []
+    for e in entries:
+        name = e.name
+        if name in names:
+            name = "%s (%s)" % (e.name, e.source)
+            i = 2
+            while name in names:
+                name = "%s (%s, %d)" % (e.name, e.source, i)
+                i += 1
+            print "Plant name %s of %s is already used, renamed to %s" % (
+                e.name, e.source, name)
+        names.add(name)
+        unique.append(e._replace(name=name))
+    return unique
+
+
+def readings(path, entry):
+    """
+    Args:
+        path: Path to a store directory.
+        entry: The Entry of the plant.
+    Returns: A read-only memory-mapped array of the plant's readings.
+    """
+    return numpy.load(os.path.join(path, entry.file), mmap_mode='r')
+
+
+def load_plant(path, entry):
+    """ Returns: The PlantData for an index entry, with memory-mapped readings. """
+    return plant.PlantData(entry.name, readings(path, entry),
+                           entry.stimuli, entry.sample_freq)
+
+
+class PlantStore:
+    """
+    Lazy access to the plants in a store.
+
+    Plants can be iterated over, looked up by name and filtered without
+    reading any readings. Readings are memory-mapped when a plant is accessed,
+    and only the most recently used plants are kept open.
+    """
+
+    def __init__(self, path, entries=None, cache_size=None, _cache=None):
+        """
+        Args:
+            path: Path to a store directory.
+            entries: Index entries to use, defaults to every plant in the store.
+            cache_size: Maximum number of plants kept open.
+        """
+        if entries is None:
+            entries = (read_index(path) or ([], {}))[0]
+
+        self.path = path
+        self.entries = list(entries)
+        self.cache_size = cache_size or default_cache_size
+        self._by_name = dict((e.name, e) for e in self.entries)
+        self._cache = OrderedDict() if _cache is None else _cache
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return (self[e.name] for e in self.entries)
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def __getitem__(self, name):
+        """ Returns: The PlantData with the given name. """
+        entry = self._by_name[name]
+
+        # move plant to the end of the cache, as it is most recently used
+        plant_data = self._cache.pop(entry.file, None)
+        if plant_data is None:
+            plant_data = load_plant(self.path, entry)
+        self._cache[entry.file] = plant_data
+
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+        return plant_data
+
+    def __getstate__(self):
+        # don't send open readings to other processes, they can map them again
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        return state
+
+    def names(self):
+        """ Returns: The names of all plants, in store order. """
+        return [e.name for e in self.entries]
+
+    def select(self, names):
+        """ Returns: A PlantStore with only the named plants, in the given order. """
+        return self._subset([self._by_name[name] for name in names])
+
+    def filter(self, stimuli=None, prefix=None):
+        """
+        Args:
+            stimuli: Stimulus types, keep plants given any of these stimuli.
+            prefix: Keep plants whose name starts with this experiment prefix.
+        Returns: A PlantStore with only the matching plants.
+        """
+        entries = self.entries
+        if stimuli is not None:
+            entries = [e for e in entries
+                       if any(s.type in stimuli for s in e.stimuli)]
+        if prefix is not None:
+            entries = [e for e in entries if e.name.startswith(prefix)]
+        return self._subset(entries)
+
+    def _subset(self, entries):
+        # subsets share open readings with this store
+        return PlantStore(self.path, entries, self.cache_size, self._cache)
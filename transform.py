@@ -3,20 +3,51 @@ import numpy as np
 import pywt
 from scipy.stats import linregress
 import datapoint
+import plant
 from scipy.signal import decimate
 import parmap
 import itertools
+import types
 
 
 class Extractor(base.BaseEstimator):
-    """ Extracts features from each datapoint. """
+    """
+    Extracts features from each datapoint.
+
+    Extractors may also define transform_batch(X), taking an array of every
+    datapoint and returning an array of every result, using numpy operations
+    over all datapoints at once. It must give the same results as applying
+    extractor to each datapoint.
+    """
 
     def __init__(self, extractor=None):
         if extractor is not None:
             self.extractor = extractor
 
     def transform(self, X):
-        return np.array(parmap.parmap(self.extractor, X), ndmin=2)
+        if isinstance(X, types.GeneratorType):
+            # lazily transform a stream of (X, y, sources) batches
+            return ((self.transform(Xb), yb, sb) for Xb, yb, sb in X)
+        T = self._transform_batch(X)
+        if T is None:
+            T = parmap.parmap(self.extractor, X)
+        return _as_result(T)
+
+    def _transform_batch(self, X):
+        """
+        Returns:
+            The result of transform_batch on X as an array, or None if it is
+            not defined or the datapoints differ in shape.
+        """
+        if not hasattr(self, 'transform_batch'):
+            return None
+        try:
+            X = np.asarray(X)
+        except ValueError:
+            return None
+        if X.dtype == object or X.ndim < 2:
+            return None
+        return self.transform_batch(X)
 
     def fit(self, X, y):
         return self
@@ -25,6 +56,137 @@ class Extractor(base.BaseEstimator):
         return self.extractor(x)
 
 
+def _as_result(T):
+    """ Returns: The results of a transform as an array. """
+    T = np.array(T, ndmin=2)
+    # keep floating point results in the type readings are stored in
+    if T.dtype.kind == 'f':
+        T = T.astype(plant.dtype, copy=False)
+    return T
+
+
+def _stateless(step):
+    """ Returns: True for an Extractor that learns nothing when fit. """
+    if isinstance(step, Map):
+        # a Map only passes fit on to its functions, plain functions have none
+        return all(not hasattr(f, 'fit') or _stateless(f)
+                   for f in step.functions)
+    cls = type(step)
+    return (isinstance(step, Extractor) and
+            cls.fit.im_func is Extractor.fit.im_func and
+            cls.transform.im_func is Extractor.transform.im_func)
+
+
+def fuse(steps, keep=()):
+    """
+    Join runs of consecutive stateless extractors in a list of pipeline steps
+    into Fused steps, so each run is a single pass over the data.
+
+    Params:
+        steps: A list of (name, transformer) pipeline steps.
+        keep: Names of steps to leave alone, e.g. those with parameters.
+    Returns: A list of pipeline steps.
+    """
+    fused = []
+    run = []
+
+    def end_run():
+        if len(run) > 1:
+            fused.append(('+'.join(name for name, step in run), Fused(run[:])))
+        else:
+            fused.extend(run)
+        del run[:]
+
+    for name, step in steps:
+        if name not in keep and _stateless(step):
+            run.append((name, step))
+        else:
+            end_run()
+            fused.append((name, step))
+    end_run()
+
+    return fused
+
+
+def _reverse_axes(X):
+    """ Returns: X with the axes of every datapoint reversed, as by x.T. """
+    return X.transpose([0] + range(X.ndim - 1, 0, -1))
+
+
+def _sum(X):
+    """
+    Returns:
+        The sum of every datapoint over its first axis, added in order as by
+        sum(x), so results are identical to summing each datapoint.
+    """
+    return np.cumsum(X, axis=1)[:, -1]
+
+
+def _power(X, n):
+    """ Returns: X to the power n, identical to x**n for every element x. """
+    # numpy scalars are raised to a power with pow in double precision, while
+    # ** on arrays takes shortcuts (e.g. square and sqrt) that can round
+    # differently
+    return np.power(X, n, dtype=np.promote_types(X.dtype, np.float64))
+
+
+def _moments(X, orders):
+    """
+    Statistics kernel, finding the mean and central moments of every
+    datapoint over its first axis, all from one set of deviations. Results are
+    identical to Mean and Moment on each datapoint.
+
+    Params:
+        X: An array of datapoints.
+        orders: The orders of the central moments to find.
+    Returns: The means, and a list of the moments of each order.
+    """
+    m = _sum(X) / X.shape[1]
+    deviations = X - m[:, np.newaxis]
+    return m, [_sum(_power(deviations, n)) / X.shape[1] for n in orders]
+
+
+class Fused(Extractor):
+    """
+    Apply several stateless extractors one after another to each datapoint.
+
+    The whole chain runs in a single parmap pass, so intermediate results
+    stay with the worker that made them and only the final results are sent
+    back. Every extractor sees exactly what it would as a separate step.
+    """
+
+    def __init__(self, steps):
+        self.steps = steps
+
+    def _transform_batch(self, X):
+        # leading whole-array extractors are fastest on all datapoints at
+        # once, and need no workers
+        batched = 0
+        for name, step in self.steps:
+            T = step._transform_batch(X)
+            if T is None:
+                break
+            X = _as_result(T)
+            batched += 1
+
+        if batched == 0:
+            return None
+        elif batched < len(self.steps):
+            X = Fused(self.steps[batched:]).transform(X)
+        return X
+
+    def extractor(self, x):
+        last = len(self.steps) - 1
+        for i, (name, step) in enumerate(self.steps):
+            x = np.asarray(x)
+            T = step._transform_batch(x[np.newaxis])
+            if T is None:
+                T = [step.extractor(x)]
+            # the final result is left as the extractor gave it
+            x = T[0] if i == last else _as_result(T)[0]
+        return x
+
+
 class MeanSubtract(Extractor):
     """ Subtracts the mean of the data from every point. """
 
@@ -49,6 +211,9 @@ class Concat(Extractor):
     def extractor(self, x):
         return np.ravel(np.array(x), 'F')
 
+    def transform_batch(self, X):
+        return _reverse_axes(X).reshape((len(X), -1))
+
 
 class Split(Extractor):
     """ Split data into equal sized parts. """
@@ -68,6 +233,9 @@ class Transpose(Extractor):
     def extractor(self, x):
         return x.T
 
+    def transform_batch(self, X):
+        return _reverse_axes(X)
+
 
 class Decimate(Extractor):
     """ Shrink signal by applying a low-pass filter. """
@@ -161,8 +329,9 @@ class Map(Extractor):
             iter(f)
         except TypeError:
             self.fs = itertools.repeat(f)
+            self.functions = [f]
         else:
-            self.fs = f
+            self.fs = self.functions = list(f)
 
         self.steps = steps
         self.divs = divs
@@ -183,6 +352,32 @@ class Map(Extractor):
         return np.ravel([f(x[i:i+steps]) for i, f in
                          zip(range(0, len(x), steps), self.fs)])
 
+    def _transform_batch(self, X):
+        """
+        Returns:
+            The results of every function on its part of all datapoints at
+            once, or None if a function has no transform_batch or the parts
+            differ in size.
+        """
+        try:
+            X = np.asarray(X)
+        except ValueError:
+            return None
+        if X.dtype == object or X.ndim < 2:
+            return None
+
+        steps = self.steps or X.shape[1] / self.divs
+        parts = []
+        for i, f in zip(range(0, X.shape[1], steps), self.fs):
+            if not isinstance(f, Extractor) or i + steps > X.shape[1]:
+                return None
+            T = f._transform_batch(X[:, i:i+steps])
+            if T is None:
+                return None
+            # as by ravel on the results of each datapoint
+            parts.append(np.reshape(T, (len(X), -1)))
+        return np.concatenate(parts, axis=1)
+
 
 class CrossCorrelation(Extractor):
     """ Calculate cross correlation between two signals. """
@@ -305,6 +500,9 @@ class PostStimulus(Extractor):
     def extractor(self, x):
         return x[self.offset-datapoint.window_offset:]
 
+    def transform_batch(self, X):
+        return X[:, self.offset-datapoint.window_offset:]
+
 
 class PreStimulus(Extractor):
     """
@@ -316,6 +514,9 @@ class PreStimulus(Extractor):
     def extractor(self, x):
         return x[0:-datapoint.window_offset]
 
+    def transform_batch(self, X):
+        return X[:, 0:-datapoint.window_offset]
+
 
 class ElectrodeOp(Extractor):
     """ Perform some operation between the two electrode channels. """
@@ -332,6 +533,13 @@ class ElectrodeOp(Extractor):
             x = x.reshape((-1, 2))
             return self.extractor(x)
 
+    def transform_batch(self, X):
+        # op must work on whole arrays, as it does for every op given here
+        if X.ndim == 2:
+            # if data is concatenated
+            X = X.reshape((len(X), -1, 2))
+        return self.op(X[:, :, 0], X[:, :, 1])
+
 
 class ElectrodeAvg(ElectrodeOp):
     """ Take the average of the two electrode values. """
@@ -354,27 +562,27 @@ class MovingAvg(Extractor):
         self.n = n
 
     def extractor(self, x):
-        mov_avg = []
+        return self.transform_batch(np.asarray(x)[np.newaxis])[0]
 
-        # maintains a running sum of window
-        accum = sum(x[:self.n])
+    def transform_batch(self, X):
+        """
+        Returns:
+            The mean of every run of n readings in every datapoint, or the sum
+            of all readings over n if a datapoint has fewer than n readings.
+        """
+        if X.shape[1] == 0:
+            return np.zeros((len(X), 0) + X.shape[2:])
 
-        for i, xx in enumerate(x):
-            # calculate mean from accumulator
-            avg = accum / self.n
-            mov_avg.append(avg)
+        # the running sum of a window starts as the sum of the first window,
+        # then each following reading is added and each first reading removed
+        # in turn, so cumulative sums of the steps match a running sum exactly
+        num = max(X.shape[1] - self.n, 0)
+        steps = np.empty((len(X), 1 + 2 * num) + X.shape[2:], dtype=X.dtype)
+        steps[:, 0] = _sum(X[:, :self.n])
+        steps[:, 1::2] = X[:, self.n:]
+        steps[:, 2::2] = -X[:, :num]
 
-            # add end of window to accumulator
-            try:
-                accum += x[i+self.n]
-            except IndexError:
-                # leave loop when reach end
-                break
-
-            # remove start of window from accumulator
-            accum -= x[i]
-
-        return mov_avg
+        return np.cumsum(steps, axis=1)[:, ::2] / self.n
 
 
 class Noise(Extractor):
@@ -385,8 +593,14 @@ class Noise(Extractor):
         self.n = n
 
     def extractor(self, x):
-        smoothed = self.mov_avg(x)
-        return [xx - ss for xx, ss in zip(x[self.n/2:-self.n/2], smoothed)]
+        return self.transform_batch(np.asarray(x)[np.newaxis])[0]
+
+    def transform_batch(self, X):
+        smoothed = self.mov_avg.transform_batch(X)
+        X = X[:, self.n/2:-self.n/2]
+        # readings with a moving average, as by zip
+        num = min(X.shape[1], smoothed.shape[1])
+        return X[:, :num] - smoothed[:, :num]
 
 
 class ICA(Extractor):
@@ -403,27 +617,29 @@ class FeatureEnsemble(Extractor):
     """ Take an ensemble of different features from the data. """
 
     def extractor(self, x):
-        m = Mean()
-        v = Var()
-        a = Abs()
-        d = Differential()
+        return self.transform_batch(np.asarray(x)[np.newaxis])[0]
 
-        avg = m(x)
-        diff1 = m(a(d(x)))
-        diff2 = m(a(d(d(x))))
+    def transform_batch(self, X):
+        # the differentials and deviations are each found only once, every
+        # feature is identical to combining Mean, Var, Abs and Differential
+        d1 = X[:, 1:] - X[:, :-1]
+        d2 = d1[:, 1:] - d1[:, :-1]
 
-        vari = v(x)
-        vardiff1 = v(d(x))
-        vardiff2 = v(d(d(x)))
+        avg, (vari, m3, m4) = _moments(X, [2, 3, 4])
+        diff1 = _sum(np.abs(d1)) / d1.shape[1]
+        diff2 = _sum(np.abs(d2)) / d2.shape[1]
+        vardiff1 = _moments(d1, [2])[1][0]
+        vardiff2 = _moments(d2, [2])[1][0]
 
-        hjorth_mob = vardiff1**0.5 / vari**0.5
-        hjorth_com = (vardiff2**0.5 / vardiff1**0.5) / hjorth_mob
+        hjorth_mob = _power(vardiff1, 0.5) / _power(vari, 0.5)
+        hjorth_com = (_power(vardiff2, 0.5) / _power(vardiff1, 0.5)) / hjorth_mob
 
-        skew = Skewness()(x)
-        kurt = Kurtosis()(x)
+        # 3/2 is integer division, as in Skewness
+        skew = m3 / _power(vari, 3/2)
+        kurt = m4 / _power(vari, 2) - 3
 
-        return [avg, diff1, diff2, vari, vardiff1, vardiff2,
-                hjorth_mob, hjorth_com, skew, kurt]
+        return np.array([avg, diff1, diff2, vari, vardiff1, vardiff2,
+                         hjorth_mob, hjorth_com, skew, kurt]).swapaxes(0, 1)
 
 
 class Abs(Extractor):
@@ -432,6 +648,9 @@ class Abs(Extractor):
     def extractor(self, x):
         return map(abs, x)
 
+    def transform_batch(self, X):
+        return np.abs(X)
+
 
 class Differential(Extractor):
     """ The change in x. """
@@ -439,6 +658,9 @@ class Differential(Extractor):
     def extractor(self, x):
         return [x2 - x1 for (x1, x2) in zip(x[:-1], x[1:])]
 
+    def transform_batch(self, X):
+        return X[:, 1:] - X[:, :-1]
+
 
 class Mean(Extractor):
     """ The average of x. """
@@ -446,6 +668,9 @@ class Mean(Extractor):
     def extractor(self, x):
         return sum(x) / len(x)
 
+    def transform_batch(self, X):
+        return _sum(X) / X.shape[1]
+
 
 class Moment(Extractor):
     """ The nth central moment. """
@@ -457,6 +682,9 @@ class Moment(Extractor):
         m = Mean()(x)
         return sum([(xx-m)**self.n for xx in x]) / len(x)
 
+    def transform_batch(self, X):
+        return _moments(X, [self.n])[1][0]
+
 
 class Var(Moment):
     """ The variance of x. """
@@ -471,6 +699,9 @@ class Stdev(Extractor):
     def extractor(self, x):
         return Var()(x)**0.5
 
+    def transform_batch(self, X):
+        return _power(Var().transform_batch(X), 0.5)
+
 
 class Skewness(Extractor):
     """ The sample skewness of x. """
@@ -478,9 +709,18 @@ class Skewness(Extractor):
     def extractor(self, x):
         return Moment(3)(x) / (Var()(x) ** (3/2))
 
+    def transform_batch(self, X):
+        m, (var, m3) = _moments(X, [2, 3])
+        # 3/2 is integer division, as in extractor
+        return m3 / _power(var, 3/2)
+
 
 class Kurtosis(Extractor):
     """ The sample kurtosis of x. """
 
     def extractor(self, x):
         return Moment(4)(x) / (Var()(x) ** 2) - 3
+
+    def transform_batch(self, X):
+        m, (var, m4) = _moments(X, [2, 4])
+        return m4 / _power(var, 2) - 3